@@ -0,0 +1,122 @@
+import asyncio
+import math
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any
+
+
+class AdmissionRejected(Exception):
+  def __init__(self, status_code: int, retry_after: int, reason: str) -> None:
+    super().__init__(reason)
+    self.status_code = status_code
+    self.retry_after = retry_after
+    self.reason = reason
+
+
+class AdmissionController:
+  """
+  同時に処理するリクエスト数を制限し, あふれた分は上限付きのキューで待たせる.
+  待ち時間が長くなりそうなリクエストは待たせずにすぐ断る(429/503 + Retry-After).
+  """
+
+  def __init__(
+    self,
+    max_concurrency: int,
+    max_queue: int,
+    max_wait_sec: float,
+    max_per_client: int | None = None,
+  ) -> None:
+    self.max_concurrency = max_concurrency
+    self.max_queue = max_queue
+    self.max_wait_sec = max_wait_sec
+    self.max_per_client = max_per_client
+    self.active = 0
+    self.waiting = 0
+    self.admitted = 0
+    self.rejected: dict[str, int] = {}
+    self.wait_time_sum = 0.0
+    self.wait_time_max = 0.0
+    # 1リクエストの処理時間の移動平均. 待ち時間の見積もりに使う(初期値はLLM呼び出し数回分の目安)
+    self.service_time_avg = 5.0
+    self._semaphore = asyncio.Semaphore(max_concurrency)
+    self._clients: dict[str, int] = {}
+
+  @property
+  def queue_depth(self) -> int:
+    # waitingにはセマフォをすぐに取れるリクエストも含まれるので, 同時実行数を超えた分を待ち行列とみなす
+    return max(0, self.active + self.waiting - self.max_concurrency)
+
+  async def acquire(self, client_id: str) -> None:
+    if self.max_per_client is not None and self._clients.get(client_id, 0) >= self.max_per_client:
+      self._reject("per_client_limit")
+      raise AdmissionRejected(429, self._retry_after(), "too many concurrent requests from this client")
+
+    if self.active + self.waiting >= self.max_concurrency:
+      if self.queue_depth >= self.max_queue:
+        self._reject("queue_full")
+        raise AdmissionRejected(503, self._retry_after(), "request queue is full")
+      if self._estimated_wait() > self.max_wait_sec:
+        self._reject("wait_too_long")
+        raise AdmissionRejected(503, self._retry_after(), "estimated wait time is too long")
+
+    self._clients[client_id] = self._clients.get(client_id, 0) + 1
+    self.waiting += 1
+    start = time.perf_counter()
+    try:
+      await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait_sec)
+    except TimeoutError:
+      self._release_client(client_id)
+      self._reject("wait_timeout")
+      raise AdmissionRejected(503, self._retry_after(), "timed out waiting in the request queue") from None
+    except BaseException:
+      self._release_client(client_id)
+      raise
+    finally:
+      self.waiting -= 1
+
+    wait_time = time.perf_counter() - start
+    self.wait_time_sum += wait_time
+    self.wait_time_max = max(self.wait_time_max, wait_time)
+    self.admitted += 1
+    self.active += 1
+
+  def release(self, client_id: str, service_time: float) -> None:
+    self.active -= 1
+    self._semaphore.release()
+    self._release_client(client_id)
+    self.service_time_avg = 0.9 * self.service_time_avg + 0.1 * service_time
+
+  @asynccontextmanager
+  async def admit(self, client_id: str) -> AsyncIterator[None]:
+    await self.acquire(client_id)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.release(client_id, time.perf_counter() - start)
+
+  def stats(self) -> dict[str, Any]:
+    return {
+      "active": self.active,
+      "queue_depth": self.queue_depth,
+      "admitted": self.admitted,
+      "rejected": dict(self.rejected),
+      "wait_time_avg": self.wait_time_sum / self.admitted if self.admitted else 0.0,
+      "wait_time_max": self.wait_time_max,
+      "service_time_avg": self.service_time_avg,
+    }
+
+  def _estimated_wait(self) -> float:
+    return (self.queue_depth + 1) / self.max_concurrency * self.service_time_avg
+
+  def _retry_after(self) -> int:
+    return max(1, math.ceil(self._estimated_wait()))
+
+  def _reject(self, reason: str) -> None:
+    self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+  def _release_client(self, client_id: str) -> None:
+    self._clients[client_id] -= 1
+    if self._clients[client_id] == 0:
+      del self._clients[client_id]
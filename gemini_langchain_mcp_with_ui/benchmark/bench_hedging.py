@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from langchain_core.messages import HumanMessage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.bench_infer import summarize  # noqa: E402
+from benchmark.fake_chat_model import ScriptedChatModel  # noqa: E402
+from hedging import HedgedChatModel  # noqa: E402
+
+# llm_serverを起動せずにHedgedChatModelだけを測るベンチマーク.
+# 一定の割合で遅くなるfakeのchat modelに対して, ヘッジ無し/有りのレイテンシの分布と追加のリクエスト数を比べる.
+#
+#   uv run python benchmark/bench_hedging.py --calls 500 --slow-rate 0.05 --slow-latency 2.0
+
+
+async def measure(model, calls: int, concurrency: int, stream: bool) -> list[float]:
+  latencies: list[float] = []
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def call(i: int) -> None:
+    async with semaphore:
+      messages = [HumanMessage(content=f"question-{i}")]
+      start = time.perf_counter()
+      if stream:
+        async for _ in model.astream(messages):
+          pass
+      else:
+        await model.ainvoke(messages)
+      latencies.append(time.perf_counter() - start)
+
+  await asyncio.gather(*(call(i) for i in range(calls)))
+  return latencies
+
+
+async def run(args: argparse.Namespace) -> dict:
+  def fake_model() -> ScriptedChatModel:
+    return ScriptedChatModel(latency_sec=args.latency, slow_rate=args.slow_rate, slow_latency_sec=args.slow_latency)
+
+  baseline = await measure(fake_model(), args.calls, args.concurrency, args.stream)
+  hedged_model = HedgedChatModel(
+    model=fake_model(),
+    percentile=args.percentile,
+    min_delay_sec=args.min_delay,
+    budget_ratio=args.budget_ratio,
+  )
+  hedged = await measure(hedged_model, args.calls, args.concurrency, args.stream)
+  return {
+    "params": vars(args),
+    "baseline": summarize(baseline),
+    "hedged": summarize(hedged),
+    "hedge_stats": hedged_model.stats(),
+  }
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="offline benchmark for HedgedChatModel")
+  parser.add_argument("--calls", type=int, default=500)
+  parser.add_argument("--concurrency", type=int, default=10)
+  parser.add_argument("--stream", action="store_true")
+  parser.add_argument("--latency", type=float, default=0.1)
+  parser.add_argument("--slow-rate", type=float, default=0.05)
+  parser.add_argument("--slow-latency", type=float, default=1.0)
+  parser.add_argument("--percentile", type=float, default=95.0)
+  parser.add_argument("--min-delay", type=float, default=0.05)
+  parser.add_argument("--budget-ratio", type=float, default=0.1)
+  args = parser.parse_args()
+  print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+  main()
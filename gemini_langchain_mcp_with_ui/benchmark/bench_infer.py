@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any
+
+import httpx
+
+# Geminiを呼ばずに UI -> llm_server -> MCP の性能を測るベンチマーク.
+# fakeのchat model(ScriptedChatModel)とfakeの検索サーバ(+ 実物のlocal_cmd_mcp_server.py)でllm_serverを起動し,
+# 並列に/inferを呼んでスループット, レイテンシのパーセンタイル, /metricsから段階ごとの内訳を集計する.
+#
+#   cd gemini_langchain_mcp_with_ui
+#   uv run python benchmark/bench_infer.py --requests 200 --concurrency 8 --output benchmark/results/main.json
+#   uv run python benchmark/bench_infer.py --baseline benchmark/results/main.json
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGE_METRICS = {
+  "request": "llm_server_request_seconds",
+  "admission_wait": "llm_server_admission_wait_seconds",
+  "llm_call": "llm_server_llm_call_seconds",
+  "tool_call": "llm_server_tool_call_seconds",
+  "serialization": "llm_server_serialization_seconds",
+}
+
+
+def write_mcp_config(path: str) -> None:
+  # fakeの検索サーバの設定はllm_serverの環境変数から渡す(start_serverで設定する)
+  passthrough = {name: name for name in ("FAKE_SEARCH_LATENCY_SEC", "FAKE_FETCH_LATENCY_SEC", "FAKE_PAGE_SIZE")}
+  config = {
+    "mcpServers": {
+      "custom_search": {
+        "command": sys.executable,
+        "args": [os.path.join(BENCH_DIR, "fake_search_mcp_server.py")],
+        "env": passthrough,
+      },
+      "terminal": {
+        "command": sys.executable,
+        "args": [os.path.join(APP_DIR, "local_cmd_mcp_server.py")],
+      },
+    }
+  }
+  with open(path, "w") as f:
+    json.dump(config, f)
+
+
+def start_server(args: argparse.Namespace, config_path: str) -> subprocess.Popen:
+  env = dict(os.environ)
+  env.update(
+    {
+      "LLM_SERVER_CONFIG": config_path,
+      "LLM_SERVER_FAKE_MODEL": "1",
+      "LLM_SERVER_FAKE_MODEL_LATENCY_SEC": str(args.llm_latency),
+      "LLM_SERVER_FAKE_MODEL_SLOW_RATE": str(args.llm_slow_rate),
+      "LLM_SERVER_FAKE_MODEL_SLOW_LATENCY_SEC": str(args.llm_slow_latency),
+      "LLM_SERVER_LLM_HEDGE": "1" if args.hedge else "0",
+      "LLM_SERVER_RESPONSE_CACHE": "1" if args.response_cache else "0",
+      "LLM_SERVER_LOG_LEVEL": "WARNING",
+      "LANGCHAIN_TRACING": "false",
+      "GOOGLE_CUSTOM_SEARCH_API_KEY": env.get("GOOGLE_CUSTOM_SEARCH_API_KEY", "dummy"),
+      "GOOGLE_CUSTOM_SEARCH_ENGINE_ID": env.get("GOOGLE_CUSTOM_SEARCH_ENGINE_ID", "dummy"),
+      "FAKE_SEARCH_LATENCY_SEC": str(args.tool_latency),
+      "FAKE_FETCH_LATENCY_SEC": str(args.tool_latency),
+      "FAKE_PAGE_SIZE": str(args.page_size),
+    }
+  )
+  os.makedirs(os.path.join(APP_DIR, "workspace"), exist_ok=True)
+  return subprocess.Popen(
+    [sys.executable, "-m", "uvicorn", "llm_server:app", "--port", str(args.port), "--workers", str(args.workers)],
+    cwd=APP_DIR,
+    env=env,
+  )
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float) -> None:
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      response = await client.get("/tools")
+      if response.status_code == 200 and response.json()["tools"]:
+        return
+    except httpx.TransportError:
+      pass
+    await asyncio.sleep(0.5)
+  raise TimeoutError("llm_server did not become ready")
+
+
+async def run_user(
+  client: httpx.AsyncClient, args: argparse.Namespace, user_id: int, queue: asyncio.Queue, results: list[dict]
+) -> None:
+  # 1ユーザ = 1クライアント. 同じセッションで--turnsターン会話してから新しいセッションを始める
+  client_id = f"bench-{user_id}"
+  session_id = None
+  turn = 0
+  while True:
+    try:
+      i = queue.get_nowait()
+    except asyncio.QueueEmpty:
+      return
+
+    input_data = {"session_id": session_id, "message": f"question-{i}", "system_prompt": "benchmark"}
+    start = time.perf_counter()
+    ttfb = None
+    status = None
+    try:
+      if args.stream:
+        async with client.stream(
+          "POST", "/infer/stream", json=input_data, headers={"X-Client-Id": client_id}
+        ) as response:
+          status = response.status_code
+          async for line in response.aiter_lines():
+            if not line:
+              continue
+            event = json.loads(line)
+            if ttfb is None and event["type"] == "token":
+              ttfb = time.perf_counter() - start
+            if event["type"] == "messages":
+              session_id = event["session_id"]
+      else:
+        response = await client.post("/infer", json=input_data, headers={"X-Client-Id": client_id})
+        status = response.status_code
+        if status == 200:
+          session_id = response.json()["session_id"]
+    except httpx.HTTPError as e:
+      status = repr(e)
+
+    results.append({"status": status, "latency": time.perf_counter() - start, "ttfb": ttfb})
+    turn += 1
+    if turn % args.turns == 0:
+      session_id = None
+
+
+def percentile(values: list[float], p: float) -> float:
+  if not values:
+    return 0.0
+  values = sorted(values)
+  index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+  return values[index]
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+  return {
+    "mean": statistics.fmean(values) if values else 0.0,
+    "p50": percentile(values, 50),
+    "p90": percentile(values, 90),
+    "p99": percentile(values, 99),
+    "max": max(values, default=0.0),
+  }
+
+
+def parse_metrics(text: str) -> dict[str, dict[str, float]]:
+  # ヒストグラムの_sumと_countからラベルごとの平均を計算する
+  sums: dict[str, float] = {}
+  counts: dict[str, float] = {}
+  for line in text.splitlines():
+    match = re.match(r"^(\w+)_(sum|count)(\{[^}]*\})? ([0-9.eE+-]+)$", line)
+    if match is None:
+      continue
+    name, kind, labels, value = match.groups()
+    key = name + (labels or "")
+    (sums if kind == "sum" else counts)[key] = float(value)
+
+  stages = {}
+  for stage, metric in STAGE_METRICS.items():
+    for key, count in counts.items():
+      if key.startswith(metric) and count:
+        stages[stage + key[len(metric) :]] = {"count": count, "mean": sums.get(key, 0.0) / count}
+  return stages
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    config_path = os.path.join(tmp_dir, "config.json")
+    write_mcp_config(config_path)
+    server = start_server(args, config_path)
+    try:
+      base_url = f"http://127.0.0.1:{args.port}"
+      limits = httpx.Limits(max_connections=args.concurrency * 2)
+      async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        await wait_ready(client, args.startup_timeout)
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for i in range(args.requests):
+          queue.put_nowait(i)
+        results: list[dict] = []
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run_user(client, args, user_id, queue, results) for user_id in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+        metrics_text = (await client.get("/metrics")).text
+        stats = (await client.get("/stats")).json()
+    finally:
+      server.terminate()
+      server.wait()
+
+  ok = [r for r in results if r["status"] == 200]
+  errors: dict[str, int] = {}
+  for r in results:
+    if r["status"] != 200:
+      errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+
+  return {
+    "id": uuid.uuid4().hex,
+    "label": args.label,
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "params": {
+      "requests": args.requests,
+      "concurrency": args.concurrency,
+      "turns": args.turns,
+      "stream": args.stream,
+      "workers": args.workers,
+      "llm_latency": args.llm_latency,
+      "llm_slow_rate": args.llm_slow_rate,
+      "llm_slow_latency": args.llm_slow_latency,
+      "hedge": args.hedge,
+      "response_cache": args.response_cache,
+      "tool_latency": args.tool_latency,
+      "page_size": args.page_size,
+    },
+    "results": {
+      "elapsed": elapsed,
+      "ok": len(ok),
+      "errors": errors,
+      "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+      "latency": summarize([r["latency"] for r in ok]),
+      "ttfb": summarize([r["ttfb"] for r in ok if r["ttfb"] is not None]) if args.stream else None,
+      # workersが1より大きい場合は/metricsに答えた1ワーカー分の内訳になる
+      "stages": parse_metrics(metrics_text),
+      "llm_hedge": stats.get("llm_hedge"),
+    },
+  }
+
+
+def compare(result: dict[str, Any], baseline: dict[str, Any]) -> None:
+  print(f"--- compared with baseline: {baseline['label']} ({baseline['timestamp']}) ---")
+  pairs = [("throughput_rps", result["results"]["throughput_rps"], baseline["results"]["throughput_rps"])]
+  for key in ("p50", "p99"):
+    pairs.append((f"latency.{key}", result["results"]["latency"][key], baseline["results"]["latency"][key]))
+  for name, value, base in pairs:
+    change = (value - base) / base * 100 if base else 0.0
+    print(f"{name}: {base:.4f} -> {value:.4f} ({change:+.1f}%)")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="offline benchmark for llm_server")
+  parser.add_argument("--requests", type=int, default=100)
+  parser.add_argument("--concurrency", type=int, default=4)
+  parser.add_argument("--turns", type=int, default=3, help="turns per session before starting a new one")
+  parser.add_argument("--stream", action="store_true", help="use /infer/stream instead of /infer")
+  parser.add_argument("--workers", type=int, default=1)
+  parser.add_argument("--llm-latency", type=float, default=0.5)
+  parser.add_argument("--llm-slow-rate", type=float, default=0.0, help="fraction of slow chat model calls")
+  parser.add_argument("--llm-slow-latency", type=float, default=0.0)
+  parser.add_argument("--hedge", action="store_true", help="enable hedged chat model calls")
+  parser.add_argument(
+    "--response-cache", action="store_true", help="enable the semantic response cache (with an offline embedding)"
+  )
+  parser.add_argument("--tool-latency", type=float, default=0.2)
+  parser.add_argument("--page-size", type=int, default=20000, help="size of the fake page contents")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--timeout", type=float, default=120.0)
+  parser.add_argument("--startup-timeout", type=float, default=60.0)
+  parser.add_argument("--label", default="")
+  parser.add_argument("--output", help="write the result as json")
+  parser.add_argument("--baseline", help="result json to compare with")
+  args = parser.parse_args()
+
+  result = asyncio.run(run(args))
+  print(json.dumps(result, indent=2))
+
+  if args.output:
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+      json.dump(result, f, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+  main()
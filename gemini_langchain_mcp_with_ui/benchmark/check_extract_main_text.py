@@ -0,0 +1,45 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GOOGLE_CUSTOM_SEARCH_API_KEY", "dummy")
+os.environ.setdefault("GOOGLE_CUSTOM_SEARCH_ENGINE_ID", "dummy")
+
+from custom_search_mcp_server import extract_main_text  # noqa: E402
+
+# extract_main_textの本文抽出を確認するスクリプト. 失敗した場合はAssertionErrorで終わる.
+#
+#   uv run python benchmark/check_extract_main_text.py
+
+ARTICLE = "<p>" + "This is the main article text of the page. " * 20 + "</p>"
+
+# (ページ内の要素, 本文と一緒に残ってはいけないテキスト)
+CASES = [
+  # タグとclass/id/roleの両方で不要な要素と判定されるもの
+  ('<nav class="nav">Home | About</nav>', "Home"),
+  ('<footer id="footer">Copyright footer</footer>', "Copyright"),
+  ('<aside class="sidebar">Sidebar links</aside>', "Sidebar"),
+  ('<nav role="navigation">Home | About</nav>', "Home"),
+  ("<nav>Home | About</nav>", "Home"),
+]
+
+# 本文を囲むclassにsidebar/nav/modalなどが含まれていても本文を残す
+WRAPPER_CLASSES = ["site-wrap has-sidebar", "container page-with-nav", "l-content modal-open"]
+
+
+def main() -> None:
+  for snippet, boilerplate in CASES:
+    text = extract_main_text(f"<html><body>{ARTICLE}{snippet}</body></html>")
+    assert "main article text" in text, snippet
+    assert boilerplate not in text, snippet
+  for classes in WRAPPER_CLASSES:
+    text = extract_main_text(
+      f'<html><body><div class="{classes}"><nav>Home</nav>{ARTICLE}<div class="sidebar">Side</div></div></body></html>'
+    )
+    assert "main article text" in text, classes
+    assert "Home" not in text and "Side" not in text, classes
+  print("ok")
+
+
+if __name__ == "__main__":
+  main()
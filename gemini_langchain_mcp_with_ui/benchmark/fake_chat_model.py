@@ -0,0 +1,136 @@
+import asyncio
+import json
+import random
+import time
+from collections.abc import AsyncIterator, Sequence
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+# 1ステップ = 1回のLLM呼び出しで出すtool呼び出しのリスト. 引数の"{input}"はユーザの入力に置き換える
+DEFAULT_SCRIPT: list[list[dict[str, Any]]] = [
+  [{"name": "search_and_pickup_top_results", "args": {"search_query": "{input}"}}],
+  [
+    {"name": "get_url_contents", "args": {"url": "https://example.com/{input}/0"}},
+    {"name": "get_url_contents", "args": {"url": "https://example.com/{input}/1"}},
+  ],
+]
+
+
+def estimate_tokens(text: str) -> int:
+  return max(1, len(text) // 4)
+
+
+class ScriptedChatModel(BaseChatModel):
+  """
+  ベンチマーク用の決定的なchat model.
+  ユーザの入力ごとにscriptの順番でtoolを呼び出し, 最後に固定の回答を返す.
+  latency_secだけ待つことでLLMのレイテンシを模擬する.
+  slow_rateの割合の呼び出しはslow_latency_secだけ待つ(テールレイテンシの模擬).
+  """
+
+  script: list[list[dict[str, Any]]] = DEFAULT_SCRIPT
+  latency_sec: float = 0.0
+  slow_rate: float = 0.0
+  slow_latency_sec: float = 0.0
+  answer: str = "これはベンチマーク用の回答です。 " * 8
+
+  @property
+  def _llm_type(self) -> str:
+    return "scripted-fake"
+
+  def _latency(self) -> float:
+    return self.slow_latency_sec if random.random() < self.slow_rate else self.latency_sec
+
+  def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+    return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+  def _next_message(self, messages: list[BaseMessage], tools: list[dict[str, Any]] | None) -> AIMessage:
+    # 直近のユーザ入力以降に何ステップ進んだかで次の動作を決める
+    user_index = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage))
+    user_input = str(messages[user_index].content)
+    step = sum(1 for m in messages[user_index:] if isinstance(m, AIMessage))
+
+    # バインドされていないtoolの呼び出しは除き, 呼び出すtoolが無くなったステップは飛ばす
+    tool_names = {tool["function"]["name"] for tool in tools or []}
+    script = [[call for call in calls if call["name"] in tool_names] for calls in self.script]
+    script = [calls for calls in script if calls]
+
+    prompt = "".join(str(m.content) for m in messages) + json.dumps(tools or [])
+    usage = {"input_tokens": estimate_tokens(prompt), "output_tokens": 0, "total_tokens": 0}
+
+    if step < len(script):
+      tool_calls = [
+        {
+          "name": call["name"],
+          "args": json.loads(json.dumps(call["args"]).replace("{input}", user_input)),
+          "id": f"call_{step}_{i}_{time.monotonic_ns()}",
+        }
+        for i, call in enumerate(script[step])
+      ]
+      usage["output_tokens"] = estimate_tokens(json.dumps([c["args"] for c in tool_calls]))
+      usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+      return AIMessage(content="", tool_calls=tool_calls, usage_metadata=usage)
+
+    usage["output_tokens"] = estimate_tokens(self.answer)
+    usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+    return AIMessage(content=self.answer, usage_metadata=usage)
+
+  def _generate(
+    self,
+    messages: list[BaseMessage],
+    stop: list[str] | None = None,
+    run_manager: CallbackManagerForLLMRun | None = None,
+    **kwargs: Any,
+  ) -> ChatResult:
+    time.sleep(self._latency())
+    return ChatResult(generations=[ChatGeneration(message=self._next_message(messages, kwargs.get("tools")))])
+
+  async def _agenerate(
+    self,
+    messages: list[BaseMessage],
+    stop: list[str] | None = None,
+    run_manager: AsyncCallbackManagerForLLMRun | None = None,
+    **kwargs: Any,
+  ) -> ChatResult:
+    await asyncio.sleep(self._latency())
+    return ChatResult(generations=[ChatGeneration(message=self._next_message(messages, kwargs.get("tools")))])
+
+  async def _astream(
+    self,
+    messages: list[BaseMessage],
+    stop: list[str] | None = None,
+    run_manager: AsyncCallbackManagerForLLMRun | None = None,
+    **kwargs: Any,
+  ) -> AsyncIterator[ChatGenerationChunk]:
+    # 最初のトークンまでにlatencyの半分, 残りを各トークンに分けて待つ
+    message = self._next_message(messages, kwargs.get("tools"))
+    latency = self._latency()
+    await asyncio.sleep(latency / 2)
+    if message.tool_calls:
+      yield ChatGenerationChunk(
+        message=AIMessageChunk(
+          content="",
+          tool_call_chunks=[
+            {"name": c["name"], "args": json.dumps(c["args"], ensure_ascii=False), "id": c["id"], "index": i}
+            for i, c in enumerate(message.tool_calls)
+          ],
+          usage_metadata=message.usage_metadata,
+        )
+      )
+      return
+
+    words = message.content.split(" ")
+    for i, word in enumerate(words):
+      text = word if i == len(words) - 1 else word + " "
+      chunk = ChatGenerationChunk(
+        message=AIMessageChunk(content=text, usage_metadata=message.usage_metadata if i == 0 else None)
+      )
+      if run_manager is not None:
+        await run_manager.on_llm_new_token(text, chunk=chunk)
+      yield chunk
+      await asyncio.sleep(latency / 2 / len(words))
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Any
+
+from mcp.server.fastmcp import FastMCP
+
+# custom_search_mcp_server.pyと同じtoolを持つベンチマーク用のサーバ.
+# Google CSEやWebページへのアクセスの代わりに決まった時間だけ待って決まった内容を返す.
+SEARCH_LATENCY_SEC = float(os.environ.get("FAKE_SEARCH_LATENCY_SEC", "0.2"))
+FETCH_LATENCY_SEC = float(os.environ.get("FAKE_FETCH_LATENCY_SEC", "0.3"))
+PAGE_SIZE = int(os.environ.get("FAKE_PAGE_SIZE", "20000"))
+
+
+@dataclass
+class SearchResultSummary:
+  title: str
+  url: str
+  description: str
+
+
+@dataclass
+class UrlContents:
+  url: str
+  contents: str
+  error: str | None = None
+
+
+mcp = FastMCP("custom_search")
+
+
+@mcp.tool()
+async def search_and_pickup_top_results(search_query: str) -> list[Any]:
+  """
+  Search for articles on the internet using
+  google custom search api.
+  If you have any questions from users that you don't understand,
+  please use this function to search for them!
+
+  Args:
+    search_query: Search keyword.
+
+  Returns:
+    Overview of top search results.
+  """
+  await asyncio.sleep(SEARCH_LATENCY_SEC)
+  return [
+    SearchResultSummary(
+      title=f"{search_query} {i}",
+      url=f"https://example.com/{search_query}/{i}",
+      description=f"{i}: description of {search_query}",
+    )
+    for i in range(3)
+  ]
+
+
+@mcp.tool()
+async def get_url_contents(url: str) -> str:
+  """
+  Returns the contents of the page at the given URL as a string.
+  Use this to find out about the contents of a specific URL.
+
+  Args:
+    url: Web page URL.
+
+  Returns:
+    Contents of the page at the given URL.
+  """
+  await asyncio.sleep(FETCH_LATENCY_SEC)
+  return fake_page(url)
+
+
+@mcp.tool()
+async def get_multiple_url_contents(urls: list[str]) -> list[UrlContents]:
+  """
+  Returns the contents of the pages at the given URLs.
+  Use this instead of calling get_url_contents repeatedly
+  when you want to read several pages, e.g. the top search results.
+
+  Args:
+    urls: Web page URLs (up to 5).
+
+  Returns:
+    Contents of each page. If a page could not be fetched, its error is set instead.
+  """
+  # 本物と同じく並列に取得するので, 待ち時間は1ページ分
+  await asyncio.sleep(FETCH_LATENCY_SEC)
+  return [
+    UrlContents(url=url, contents=fake_page(url))
+    if i < 5
+    else UrlContents(url=url, contents="", error="too many URLs (max 5)")
+    for i, url in enumerate(dict.fromkeys(urls))
+  ]
+
+
+def fake_page(url: str) -> str:
+  line = f"contents of {url}\n"
+  return (line * (PAGE_SIZE // len(line) + 1))[:PAGE_SIZE]
+
+
+if __name__ == "__main__":
+  mcp.run(transport=os.environ.get("MCP_TRANSPORT", "stdio"))
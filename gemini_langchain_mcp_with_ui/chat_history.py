@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+  id TEXT PRIMARY KEY,
+  personality TEXT NOT NULL,
+  session_id TEXT,
+  created_at REAL NOT NULL,
+  updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+  conversation_id TEXT NOT NULL,
+  seq INTEGER NOT NULL,
+  role TEXT NOT NULL,
+  content TEXT NOT NULL,
+  PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID;
+"""
+
+
+@dataclass
+class ChatEntry:
+  # 描画用に変換済みのメッセージ. 受け取ったときに1回だけ変換する
+  role: str
+  content: str
+  # 会話内での通し番号. 保存する前は-1
+  seq: int = -1
+
+
+@dataclass
+class Conversation:
+  conversation_id: str
+  personality: str
+  # 推論サーバ側のセッションID
+  session_id: str | None
+
+
+class ChatHistory:
+  """
+  UIの会話履歴をSQLite(WAL)に保存するストア.
+  メッセージは描画用に変換済みの(role, content)の行で会話ごとに通し番号をつけて保存し,
+  ページ単位(新しい方から)で読み出す.
+  """
+
+  def __init__(self, path: str) -> None:
+    # streamlitはスクリプトを別スレッドで実行するので, 1つの接続をロックして共有する
+    self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._conn.execute("PRAGMA journal_mode=WAL")
+      self._conn.execute("PRAGMA synchronous=NORMAL")
+      self._conn.executescript(SCHEMA)
+
+  def create(self, personality: str) -> Conversation:
+    conversation = Conversation(conversation_id=uuid.uuid4().hex, personality=personality, session_id=None)
+    now = time.time()
+    with self._lock:
+      self._conn.execute(
+        "INSERT INTO conversations (id, personality, session_id, created_at, updated_at) VALUES (?, ?, NULL, ?, ?)",
+        (conversation.conversation_id, personality, now, now),
+      )
+    return conversation
+
+  def get(self, conversation_id: str) -> Conversation | None:
+    with self._lock:
+      row = self._conn.execute(
+        "SELECT personality, session_id FROM conversations WHERE id = ?", (conversation_id,)
+      ).fetchone()
+    if row is None:
+      return None
+    return Conversation(conversation_id=conversation_id, personality=row[0], session_id=row[1])
+
+  def set_session_id(self, conversation_id: str, session_id: str) -> None:
+    with self._lock:
+      self._conn.execute(
+        "UPDATE conversations SET session_id = ?, updated_at = ? WHERE id = ?",
+        (session_id, time.time(), conversation_id),
+      )
+
+  def append(self, conversation_id: str, entries: list[ChatEntry]) -> None:
+    # 1ターン分のメッセージを1トランザクションで末尾に追加し, 各entryに通し番号を設定する
+    if not entries:
+      return
+    with self._lock:
+      self._conn.execute("BEGIN IMMEDIATE")
+      try:
+        (last_seq,) = self._conn.execute(
+          "SELECT COALESCE(MAX(seq), -1) FROM messages WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        for i, entry in enumerate(entries, start=last_seq + 1):
+          entry.seq = i
+        self._conn.executemany(
+          "INSERT INTO messages (conversation_id, seq, role, content) VALUES (?, ?, ?, ?)",
+          [(conversation_id, entry.seq, entry.role, entry.content) for entry in entries],
+        )
+        self._conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (time.time(), conversation_id))
+        self._conn.execute("COMMIT")
+      except BaseException:
+        self._conn.execute("ROLLBACK")
+        raise
+
+  def page(self, conversation_id: str, limit: int, before_seq: int | None = None) -> list[ChatEntry]:
+    # before_seqより前(指定しなければ最新)のlimit件を古い順で返す
+    if before_seq is None:
+      before_seq = 2**62
+    with self._lock:
+      rows = self._conn.execute(
+        "SELECT seq, role, content FROM messages WHERE conversation_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+        (conversation_id, before_seq, limit),
+      ).fetchall()
+    return [ChatEntry(role=role, content=content, seq=seq) for seq, role, content in reversed(rows)]
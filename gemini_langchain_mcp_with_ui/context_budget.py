@@ -0,0 +1,116 @@
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import get_buffer_string
+
+# メッセージ1件あたりのロールなどのオーバーヘッド(トークン)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """これまでの会話の要約と, その続きの会話が与えられます.
+続きの会話の内容を反映した新しい要約を書いてください.
+ユーザの目的, 決まったこと, toolで調べた重要な事実を残し, 要約だけを出力してください.
+
+# これまでの要約
+{summary}
+
+# 続きの会話
+{conversation}"""
+
+
+def estimate_tokens(message: BaseMessage) -> int:
+  # 正確なトークン数ではなくUTF-8のバイト数/4を目安にする(英語は4文字, 日本語は1文字あたり0.75トークン程度)
+  content = message.content if isinstance(message.content, str) else str(message.content)
+  size = len(content.encode())
+  if isinstance(message, AIMessage):
+    size += sum(len(call["name"]) + len(str(call["args"]).encode()) for call in message.tool_calls)
+  return size // 4 + MESSAGE_OVERHEAD_TOKENS
+
+
+def shrink_tool_output(message: BaseMessage, max_tokens: int) -> BaseMessage:
+  # 大きなtoolの出力は先頭と末尾を残して中央を省略する. 元のメッセージ(会話履歴)は変更しない
+  if not isinstance(message, ToolMessage) or not isinstance(message.content, str):
+    return message
+  data = message.content.encode()
+  max_bytes = max_tokens * 4
+  if len(data) <= max_bytes:
+    return message
+  head = data[: max_bytes * 3 // 4].decode(errors="ignore")
+  tail = data[-(max_bytes // 4) :].decode(errors="ignore")
+  content = f"{head}\n...({len(data) - max_bytes} bytes omitted)...\n{tail}"
+  return message.model_copy(update={"content": content})
+
+
+def split_turns(messages: list[BaseMessage]) -> list[list[BaseMessage]]:
+  # human messageごとに区切る. tool呼び出しと対応するToolMessageは必ず同じターンに入る
+  turns: list[list[BaseMessage]] = []
+  for message in messages:
+    if isinstance(message, HumanMessage) or not turns:
+      turns.append([])
+    turns[-1].append(message)
+  return turns
+
+
+def with_summary(system: list[BaseMessage], summary: str) -> list[BaseMessage]:
+  # geminiは先頭以外のsystem messageを無視することがあるので, 要約は先頭のsystem messageにまとめる
+  if not summary:
+    return system
+  text = f"# これまでの会話の要約\n{summary}"
+  if not system:
+    return [SystemMessage(content=text)]
+  return [SystemMessage(content=f"{system[0].content}\n\n{text}")]
+
+
+class ContextBudget:
+  """
+  LLMに送る会話履歴をトークン数の予算に収める.
+  先頭のsystem messageと最新のターンは必ず残し, 古いターンからターン単位で落とす.
+  """
+
+  def __init__(self, max_tokens: int, max_tool_output_tokens: int) -> None:
+    self.max_tokens = max_tokens
+    self.max_tool_output_tokens = max_tool_output_tokens
+
+  def fit(self, messages: list[BaseMessage]) -> list[BaseMessage]:
+    system, kept, _ = self._split(messages)
+    return system + kept
+
+  def dropped_count(self, messages: list[BaseMessage]) -> int:
+    # 予算に収まらずに落とされる(system message以外の)先頭のメッセージ数
+    _, _, dropped = self._split(messages)
+    return dropped
+
+  def tokens(self, messages: list[BaseMessage]) -> int:
+    return sum(estimate_tokens(message) for message in messages)
+
+  def _split(self, messages: list[BaseMessage]) -> tuple[list[BaseMessage], list[BaseMessage], int]:
+    system = messages[:1] if messages and isinstance(messages[0], SystemMessage) else []
+    history = messages[len(system) :]
+    turns = [
+      [shrink_tool_output(message, self.max_tool_output_tokens) for message in turn] for turn in split_turns(history)
+    ]
+    if not turns:
+      return system, [], 0
+
+    # 最新のターンは予算を超えても残す
+    kept = [turns[-1]]
+    used = self.tokens(system) + self.tokens(turns[-1])
+    for turn in reversed(turns[:-1]):
+      # tool呼び出しの途中から始まらないようにhuman messageから始まるターンだけを残す
+      if not isinstance(turn[0], HumanMessage):
+        break
+      used += self.tokens(turn)
+      if used > self.max_tokens:
+        break
+      kept.append(turn)
+
+    kept_messages = [message for turn in reversed(kept) for message in turn]
+    return system, kept_messages, len(history) - len(kept_messages)
+
+
+async def summarize(
+  model: BaseChatModel, summary: str, messages: list[BaseMessage], max_tool_output_tokens: int
+) -> str:
+  # 前回の要約に新しく予算から外れたメッセージだけを足して要約し直す(毎回全体を要約しない)
+  messages = [shrink_tool_output(message, max_tool_output_tokens) for message in messages]
+  prompt = SUMMARY_PROMPT.format(summary=summary or "(なし)", conversation=get_buffer_string(messages))
+  response = await model.ainvoke(prompt)
+  return response.content if isinstance(response.content, str) else str(response.content)
@@ -1,14 +1,98 @@
+import asyncio
+import codecs
 import os
+import re
+import sys
+import time
 from dataclasses import dataclass
 from typing import Any
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from charset_normalizer import from_bytes
+from lxml import html as lxml_html
 from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp.exceptions import ToolError
+
+from page_cache import PageCache
 
 GOOGLE_CUSTOM_SEARCH_API_KEY = os.environ["GOOGLE_CUSTOM_SEARCH_API_KEY"]
 GOOGLE_CUSTOM_SEARCH_ENGINE_ID = os.environ["GOOGLE_CUSTOM_SEARCH_ENGINE_ID"]
 
+# 検索とページの取得で共有するHTTPクライアントの設定
+HTTP_CONNECT_TIMEOUT_SEC = 5.0
+HTTP_READ_TIMEOUT_SEC = 20.0
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+# 同時に実行するHTTPリクエストの上限
+HTTP_MAX_CONCURRENCY = 8
+# 複数のURLをまとめて取得する場合のURL数の上限と, 1つのURLあたりのタイムアウト(テキスト化まで含む)
+BATCH_MAX_URLS = 5
+BATCH_URL_TIMEOUT_SEC = 30.0
+
+# ページの本文はこのサイズまでしか読まない(超えた分は捨ててテキスト化する)
+HTTP_MAX_CONTENT_BYTES = 2 * 1024 * 1024
+
+# 取得したページのテキストのキャッシュ(SQLite). 有効期限はCache-Controlに従い, max_ttlで上限を決める
+PAGE_CACHE_PATH = os.environ.get("PAGE_CACHE_PATH", "page_cache.sqlite3")
+PAGE_CACHE_MAX_BYTES = 100 * 1024 * 1024
+PAGE_CACHE_MAX_TTL_SEC = 24 * 60 * 60
+# 文字コードを<meta>から探す範囲と, 内容から推定するときに使うサイズ
+CHARSET_META_BYTES = 4096
+CHARSET_DETECT_BYTES = 64 * 1024
+
+# 本文を含まないので必ず取り除くタグ
+NON_CONTENT_TAGS = ["script", "style", "noscript", "template", "svg", "iframe"]
+# ナビゲーションなどによく使われるタグ. ページ全体を囲んでいることもあるので本文を含む場合は残す
+# (記事の中の<header>は見出しや日付なので対象にしない)
+BOILERPLATE_XPATH = (
+  "//form | //button | //nav | //footer | //aside | //header[not(ancestor::article or ancestor::main)]"
+)
+# roleと, classの各トークン/idがこれと一致する要素はナビゲーションや広告などとして取り除く
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary", "search"}
+BOILERPLATE_NAMES = {
+  "nav",
+  "navbar",
+  "navigation",
+  "global-nav",
+  "menu",
+  "breadcrumb",
+  "breadcrumbs",
+  "sidebar",
+  "footer",
+  "site-footer",
+  "cookie",
+  "cookies",
+  "cookie-banner",
+  "cookie-notice",
+  "banner",
+  "share",
+  "social",
+  "social-share",
+  "share-buttons",
+  "related",
+  "related-posts",
+  "related-articles",
+  "comments",
+  "ad",
+  "ads",
+  "advert",
+  "advertisement",
+  "promo",
+  "popup",
+  "modal",
+  "subscribe",
+}
+# 取り除こうとした要素がbodyのテキストのこの割合以上を含む場合は本文を囲んでいるとみなして残す
+BOILERPLATE_MAX_TEXT_RATIO = 0.5
+# 本文として取り出したテキストがこれより短い場合は, タグだけで不要な部分を除いたbody全体のテキストを使う
+MIN_MAIN_TEXT_CHARS = 200
+WORD_PATTERN = re.compile(r"\w")
+META_CHARSET_PATTERN = re.compile(rb"<meta[^>]+charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+
+http_client: httpx.AsyncClient | None = None
+http_semaphore = asyncio.Semaphore(HTTP_MAX_CONCURRENCY)
+page_cache = PageCache(PAGE_CACHE_PATH, max_bytes=PAGE_CACHE_MAX_BYTES, max_ttl_sec=PAGE_CACHE_MAX_TTL_SEC)
+
 
 @dataclass
 class SearchResultSummary:
@@ -17,10 +101,185 @@ class SearchResultSummary:
   description: str
 
 
+@dataclass
+class RawPage:
+  status_code: int
+  headers: httpx.Headers
+  content: bytes
+  content_type: str
+  # Content-Typeヘッダで指定された文字コード
+  charset: str | None
+
+
+@dataclass
+class UrlContents:
+  url: str
+  contents: str
+  # 取得に失敗した場合はその理由. contentsは空になる
+  error: str | None = None
+
+
 mcp = FastMCP("custom_search")
 
 
-def google_custom_search(query: str, num_results: int = 3) -> list[Any]:
+def get_http_client() -> httpx.AsyncClient:
+  # keep-aliveの接続をtoolの呼び出し(SSEでは接続してきたクライアント)をまたいで使い回す
+  global http_client
+  if http_client is None:
+    http_client = httpx.AsyncClient(
+      timeout=httpx.Timeout(HTTP_READ_TIMEOUT_SEC, connect=HTTP_CONNECT_TIMEOUT_SEC),
+      limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+      ),
+      follow_redirects=True,
+    )
+  return http_client
+
+
+async def http_get(url: str, params: dict[str, Any] | None = None) -> httpx.Response:
+  async with http_semaphore:
+    return await get_http_client().get(url, params=params)
+
+
+async def download(url: str, headers: dict[str, str] | None = None) -> RawPage:
+  # 本文はストリーミングで読み, HTTP_MAX_CONTENT_BYTESに達したら残りは読まずに接続を閉じる
+  async with http_semaphore:
+    async with get_http_client().stream("GET", url, headers=headers) as response:
+      # 304(条件付きGETで変更なし)は本文が無いのでそのまま返す
+      if response.status_code != 304:
+        response.raise_for_status()
+      chunks = []
+      size = 0
+      async for chunk in response.aiter_bytes():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= HTTP_MAX_CONTENT_BYTES:
+          break
+      return RawPage(
+        status_code=response.status_code,
+        headers=response.headers,
+        content=b"".join(chunks)[:HTTP_MAX_CONTENT_BYTES],
+        content_type=response.headers.get("content-type", ""),
+        charset=response.charset_encoding,
+      )
+
+
+def detect_encoding(page: RawPage) -> str:
+  # ヘッダ -> <meta> -> 先頭部分の内容からの推定, の順に文字コードを決める(ページ全体の推定はしない)
+  candidates = [page.charset]
+  match = META_CHARSET_PATTERN.search(page.content[:CHARSET_META_BYTES])
+  if match is not None:
+    candidates.append(match.group(1).decode("ascii", errors="ignore"))
+  for charset in candidates:
+    if charset:
+      try:
+        return codecs.lookup(charset).name
+      except LookupError:
+        pass
+  best = from_bytes(page.content[:CHARSET_DETECT_BYTES]).best()
+  return best.encoding if best is not None else "utf-8"
+
+
+def extract_main_text(html: str) -> str:
+  # BeautifulSoupはPythonでツリーを作るので遅い. lxmlのツリーのまま不要な要素を消してテキストを取り出す
+  text = _extract_main_text(html, use_names=True)
+  if len(text) < MIN_MAIN_TEXT_CHARS:
+    # role/class/idの判定で本文まで消してしまった場合に備えて, タグだけで判定した結果と長い方を使う
+    fallback = _extract_main_text(html, use_names=False)
+    if len(fallback) > len(text):
+      return fallback
+  return text
+
+
+def _extract_main_text(html: str, use_names: bool) -> str:
+  # パーサはスレッド間で共有しない
+  parser = lxml_html.HTMLParser(encoding="utf-8", remove_comments=True)
+  doc = lxml_html.document_fromstring(html.encode(), parser=parser)
+  title = (doc.findtext(".//title") or "").strip()
+
+  for element in doc.iter(*NON_CONTENT_TAGS):
+    element.drop_tree()
+  body = doc.find("body")
+  body_length = len(body.text_content()) if body is not None else 0
+
+  def contains_content(element: Any) -> bool:
+    if element.find(".//main") is not None or element.find(".//article") is not None:
+      return True
+    return len(element.text_content()) >= body_length * BOILERPLATE_MAX_TEXT_RATIO
+
+  # <nav class="nav">のようにタグとclass/idの両方で該当する要素があるので重複を除く
+  candidates = dict.fromkeys(doc.xpath(BOILERPLATE_XPATH))
+  if use_names:
+    for element in doc.xpath("//*[@id or @class or @role]"):
+      if element.tag in ("html", "body", "main", "article"):
+        continue
+      names = {element.get("id", "").lower(), *element.get("class", "").lower().split()}
+      if element.get("role") in BOILERPLATE_ROLES or not names.isdisjoint(BOILERPLATE_NAMES):
+        candidates[element] = None
+  for element in candidates:
+    # 取り除き済みの要素はdrop_tree()できない
+    if element.getparent() is not None and not contains_content(element):
+      element.drop_tree()
+
+  # 本文: <main> -> 一番長い<article> -> <body>
+  roots = doc.xpath("//main | //*[@role='main']")
+  if not roots:
+    roots = sorted(doc.xpath("//article"), key=lambda article: len(article.text_content()), reverse=True)
+  root = roots[0] if roots else doc.find("body")
+  if root is None:
+    root = doc
+
+  # 記号だけの行(区切りの"|"など)と, 直前と同じ行は落とす
+  lines = [title] if title else []
+  for text in root.itertext():
+    for line in text.splitlines():
+      line = line.strip()
+      if WORD_PATTERN.search(line) and (not lines or lines[-1] != line):
+        lines.append(line)
+  return "\n".join(lines)
+
+
+def extract_text(page: RawPage) -> str:
+  # 文字コードの判定とhtmlのパースはCPUを使うので, イベントループを止めないように別スレッドで実行する
+  text = page.content.decode(detect_encoding(page), errors="replace")
+  mime_type = page.content_type.split(";")[0].strip().lower()
+  if mime_type == "text/plain":
+    return text
+  if mime_type and "html" not in mime_type and "xml" not in mime_type:
+    raise ValueError(f"unsupported content type: {mime_type}")
+  return extract_main_text(text)
+
+
+async def fetch_url_contents(url: str) -> str:
+  # キャッシュが有効期限内ならネットワークにもテキスト化にもコストをかけずに返す
+  cached = page_cache.get(url)
+  if cached is not None and cached.is_fresh(time.time()):
+    return cached.text
+
+  page = await download(url, cached.validators() if cached is not None else None)
+  if page.status_code == 304 and cached is not None:
+    page_cache.refresh(url, page.headers)
+    return cached.text
+
+  text = await asyncio.to_thread(extract_text, page)
+  # 空のテキストはJavaScriptで描画するページなどなので, 有効期限の間使い回さない
+  if text.strip():
+    page_cache.put(url, text, page.headers)
+  return text
+
+
+async def fetch_url_contents_or_error(url: str) -> UrlContents:
+  try:
+    contents = await asyncio.wait_for(fetch_url_contents(url), BATCH_URL_TIMEOUT_SEC)
+  except TimeoutError:
+    return UrlContents(url=url, contents="", error=f"timed out after {BATCH_URL_TIMEOUT_SEC}s")
+  except Exception as e:
+    print(f"Failed to get contents({url}): {e}", file=sys.stderr)
+    return UrlContents(url=url, contents="", error=repr(e))
+  return UrlContents(url=url, contents=contents)
+
+
+async def google_custom_search(query: str, num_results: int = 3) -> list[Any]:
   url = "https://www.googleapis.com/customsearch/v1"
   params: dict[str, Any] = {
     "key": GOOGLE_CUSTOM_SEARCH_API_KEY,
@@ -29,10 +288,11 @@ def google_custom_search(query: str, num_results: int = 3) -> list[Any]:
     "num": num_results,
   }
 
-  response = requests.get(url, params=params)
+  response = await http_get(url, params=params)
   if response.status_code != 200:
-    print(f"Error: {response.status_code} - {response.text}")
-    return []
+    print(f"Error: {response.status_code} - {response.text}", file=sys.stderr)
+    # 空の結果を返すと検索結果が0件だったのと区別できず, tool結果のキャッシュにも残るのでエラーにする
+    raise ToolError(f"search failed with status {response.status_code}")
 
   results = response.json().get("items", [])
   top_results = []
@@ -78,7 +338,7 @@ async def search_and_pickup_top_results(search_query: str) -> list[Any]:
   """
   top_ranks = []
   # results = google_custom_search_dummy(search_query)
-  results = google_custom_search(search_query)
+  results = await google_custom_search(search_query)
 
   print("---------------------------------------------------------------")
   print("search result")
@@ -110,26 +370,50 @@ async def get_url_contents(url: str) -> str:
   """
   result = ""
   try:
-    response = requests.get(url)
-    response.encoding = response.apparent_encoding
-    html = response.text
-
-    # htmlのパース
-    soup = BeautifulSoup(html, "html.parser")
-
-    # htmlタグを除去して内容をテキスト化
-    text = soup.get_text(separator="\n", strip=True)
-    result = "\n".join(line for line in text.splitlines() if line.strip())
+    result = await fetch_url_contents(url)
   except Exception as e:
-    print(f"Failed to get contents({url}): {e}")
+    print(f"Failed to get contents({url}): {e}", file=sys.stderr)
     result = f"ページの内容取得に失敗しました({url})"
   return result
 
 
+@mcp.tool()
+async def get_multiple_url_contents(urls: list[str]) -> list[UrlContents]:
+  """
+  Returns the contents of the pages at the given URLs.
+  Use this instead of calling get_url_contents repeatedly
+  when you want to read several pages, e.g. the top search results.
+
+  Args:
+    urls: Web page URLs (up to 5).
+
+  Returns:
+    Contents of each page. If a page could not be fetched, its error is set instead.
+  """
+  # 同じURLは1回だけ取得する. 並列数はhttp_semaphoreで制限される
+  urls = list(dict.fromkeys(urls))
+  results = await asyncio.gather(*(fetch_url_contents_or_error(url) for url in urls[:BATCH_MAX_URLS]))
+  # 上限を超えた分も取得しなかったことが分かるようにURLごとにエラーを返す
+  skipped = [
+    UrlContents(url=url, contents="", error=f"too many URLs (max {BATCH_MAX_URLS})") for url in urls[BATCH_MAX_URLS:]
+  ]
+  return [*results, *skipped]
+
+
+@mcp.resource(
+  "cache://pages/stats",
+  description="Page cache statistics: hits, revalidated (304), misses, entries and total bytes.",
+  mime_type="application/json",
+)
+def page_cache_stats() -> dict[str, int]:
+  return page_cache.stats()
+
+
 if __name__ == "__main__":
   # import asyncio
 
   # result = asyncio.run(get_url_contents("https://www.npr.org/sections/strange-news/"))
   # print(result)
   # asyncio.run(get_url_contents("https://www3.nhk.or.jp/news/catnew.html"))
-  mcp.run(transport="stdio")
+  # サイドカーとして起動する場合はMCP_TRANSPORT=sse, FASTMCP_HOST/FASTMCP_PORTで待ち受け先を指定する
+  mcp.run(transport=os.environ.get("MCP_TRANSPORT", "stdio"))
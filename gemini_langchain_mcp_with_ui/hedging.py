@@ -0,0 +1,184 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Sequence
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from metrics import LLM_HEDGE_EVENTS
+
+
+class HedgedChatModel(BaseChatModel):
+  """
+  LLM呼び出しのテールレイテンシを減らすためのラッパー.
+  直近のレイテンシのpercentileを過ぎても応答(ストリーミングでは最初のチャンク)が無ければ
+  同じリクエストをもう1つ送り, 先に返った方を使ってもう一方はキャンセルする.
+  追加のリクエストはbudget_ratio(呼び出し数に対する割合)を超えない範囲でしか送らない.
+  """
+
+  model: BaseChatModel
+  percentile: float = 95.0
+  min_delay_sec: float = 0.5
+  budget_ratio: float = 0.1
+  # ヘッジを始めるまでに必要なレイテンシのサンプル数と, 保持するサンプル数
+  min_samples: int = 20
+  window_size: int = 200
+
+  _latencies: dict[str, deque[float]] = PrivateAttr(default_factory=dict)
+  _calls: int = PrivateAttr(default=0)
+  _hedges: int = PrivateAttr(default=0)
+  _wins: int = PrivateAttr(default=0)
+
+  @property
+  def _llm_type(self) -> str:
+    return f"hedged-{self.model._llm_type}"
+
+  def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+    # toolの変換は元のモデルに任せ, 変換後の引数(tools=...など)をこのモデルにbindする
+    return self.bind(**self.model.bind_tools(tools, **kwargs).kwargs)
+
+  def hedge_delay(self, kind: str) -> float | None:
+    # ヘッジするまでの待ち時間. サンプルが足りない場合はヘッジしない(None)
+    latencies = self._latencies.get(kind)
+    if latencies is None or len(latencies) < self.min_samples:
+      return None
+    values = sorted(latencies)
+    index = min(len(values) - 1, int(len(values) * self.percentile / 100))
+    return max(self.min_delay_sec, values[index])
+
+  def stats(self) -> dict[str, Any]:
+    return {
+      "calls": self._calls,
+      "hedges": self._hedges,
+      "wins": self._wins,
+      "hedge_rate": self._hedges / self._calls if self._calls else 0.0,
+      "win_rate": self._wins / self._hedges if self._hedges else 0.0,
+    }
+
+  def _record(self, kind: str, latency: float) -> None:
+    self._latencies.setdefault(kind, deque(maxlen=self.window_size)).append(latency)
+
+  def _start_call(self) -> None:
+    self._calls += 1
+    LLM_HEDGE_EVENTS.inc(1, "call")
+
+  def _start_hedge(self) -> bool:
+    # 追加のリクエストが予算を超える場合はヘッジせずに最初のリクエストを待つ
+    if self._hedges >= self.budget_ratio * self._calls:
+      LLM_HEDGE_EVENTS.inc(1, "budget_exhausted")
+      return False
+    self._hedges += 1
+    LLM_HEDGE_EVENTS.inc(1, "hedged")
+    return True
+
+  def _hedge_won(self) -> None:
+    self._wins += 1
+    LLM_HEDGE_EVENTS.inc(1, "hedge_won")
+
+  def _generate(
+    self,
+    messages: list[BaseMessage],
+    stop: list[str] | None = None,
+    run_manager: CallbackManagerForLLMRun | None = None,
+    **kwargs: Any,
+  ) -> ChatResult:
+    # 同期呼び出しはヘッジしない
+    return self.model._generate(messages, stop=stop, **kwargs)
+
+  async def _agenerate(
+    self,
+    messages: list[BaseMessage],
+    stop: list[str] | None = None,
+    run_manager: AsyncCallbackManagerForLLMRun | None = None,
+    **kwargs: Any,
+  ) -> ChatResult:
+    self._start_call()
+    start = time.perf_counter()
+    delay = self.hedge_delay("generate")
+    tasks = [asyncio.create_task(self.model._agenerate(messages, stop=stop, **kwargs))]
+    try:
+      done, _ = await asyncio.wait(tasks, timeout=delay)
+      if not done and self._start_hedge():
+        tasks.append(asyncio.create_task(self.model._agenerate(messages, stop=stop, **kwargs)))
+
+      winner = await _first_success(tasks)
+      if winner is not tasks[0]:
+        self._hedge_won()
+      result = winner.result()
+      self._record("generate", time.perf_counter() - start)
+      return result
+    finally:
+      for task in tasks:
+        task.cancel()
+
+  async def _astream(
+    self,
+    messages: list[BaseMessage],
+    stop: list[str] | None = None,
+    run_manager: AsyncCallbackManagerForLLMRun | None = None,
+    **kwargs: Any,
+  ) -> AsyncIterator[ChatGenerationChunk]:
+    # 最初のチャンクが来るまでの時間でヘッジし, 最初のチャンクを返したストリームだけを最後まで読む
+    if type(self.model)._astream is BaseChatModel._astream:
+      result = await self._agenerate(messages, stop=stop, **kwargs)
+      generation = result.generations[0]
+      # ChatGenerationChunkにはAIMessageChunkしか入れられないので変換する
+      message = AIMessageChunk(**generation.message.model_dump(exclude={"type", "tool_call_chunks"}))
+      yield ChatGenerationChunk(message=message, generation_info=generation.generation_info)
+      return
+
+    self._start_call()
+    start = time.perf_counter()
+    delay = self.hedge_delay("stream")
+    streams = [self.model._astream(messages, stop=stop, **kwargs)]
+    tasks = [asyncio.create_task(anext(streams[0]))]
+    try:
+      done, _ = await asyncio.wait(tasks, timeout=delay)
+      if not done and self._start_hedge():
+        streams.append(self.model._astream(messages, stop=stop, **kwargs))
+        tasks.append(asyncio.create_task(anext(streams[1])))
+
+      winner = await _first_success(tasks)
+      index = tasks.index(winner)
+      if index != 0:
+        self._hedge_won()
+      self._record("stream", time.perf_counter() - start)
+    except BaseException:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      for stream in streams:
+        await stream.aclose()
+      raise
+
+    # 負けた方のストリームを止める
+    for i, task in enumerate(tasks):
+      if i != index:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await streams[i].aclose()
+
+    try:
+      chunk = winner.result()
+    except StopAsyncIteration:
+      return
+    yield chunk
+    async for chunk in streams[index]:
+      yield chunk
+
+
+async def _first_success(tasks: list[asyncio.Task]) -> asyncio.Task:
+  # 最初に成功したタスクを返す. すべて失敗した場合は最後に失敗したタスクを返す
+  pending = set(tasks)
+  while True:
+    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+      if task.exception() is None or isinstance(task.exception(), StopAsyncIteration):
+        return task
+    if not pending:
+      return done.pop()
@@ -1,3 +1,4 @@
+import os
 from dataclasses import dataclass, fields, make_dataclass
 
 import serial
@@ -66,7 +67,8 @@ async def emotional_led_matrix(input: LedMatrixInput) -> str:
 
 
 if __name__ == "__main__":
-  mcp.run(transport="stdio")
+  # サイドカーとして起動する場合はMCP_TRANSPORT=sse, FASTMCP_HOST/FASTMCP_PORTで待ち受け先を指定する
+  mcp.run(transport=os.environ.get("MCP_TRANSPORT", "stdio"))
   # import asyncio
 
   # color = Color(10, 0, 0)
@@ -1,29 +1,139 @@
-import ast
+import asyncio
+import hashlib
 import json
+import logging
 import os
-from contextlib import AsyncExitStack
-
-from fastapi import FastAPI
-from langchain_core.messages import ToolMessage
+import time
+from collections import Counter, OrderedDict
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.messages.base import messages_to_dict
-from langchain_core.messages.utils import messages_from_dict
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_mcp_adapters.resources import load_mcp_resources
-from langchain_mcp_adapters.tools import load_mcp_tools
-from langgraph.prebuilt import create_react_agent
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from langchain_core.tools import BaseTool
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langgraph.prebuilt import ToolNode, create_react_agent
 from pydantic import BaseModel
 
+from admission import AdmissionController, AdmissionRejected
+from context_budget import ContextBudget, summarize, with_summary
+from hedging import HedgedChatModel
+from log_config import MessagesView, setup_logging
+from mcp_servers import McpServer, format_tool_error, request_deadline, start_servers
+from metrics import (
+  REGISTRY,
+  REQUEST_SECONDS,
+  SERIALIZATION_SECONDS,
+  TOKEN_BUCKETS,
+  Gauge,
+  Histogram,
+  MetricsCallbackHandler,
+)
+from response_cache import EmbedFn, SemanticResponseCache, hashing_embedding, make_scope
+from session_store import Session, SessionStore
+from tool_cache import NEVER_CACHE_TOOLS, ToolResultCache
+from tool_selector import ToolIndex, build_tool_index
+
 # for langsmith
-os.environ["LANGCHAIN_TRACING"] = "true"
+# ベンチマークではLANGCHAIN_TRACING=falseで無効にする
+os.environ.setdefault("LANGCHAIN_TRACING", "true")
 os.environ["LANGSMITH_ENDPOINT"] = "https://api.smith.langchain.com"
 os.environ["LANGSMITH_PROJECT"] = "Welld"
 
 GOOGLE_CUSTOM_SEARCH_API_KEY = os.environ["GOOGLE_CUSTOM_SEARCH_API_KEY"]
 GOOGLE_CUSTOM_SEARCH_ENGINE_ID = os.environ["GOOGLE_CUSTOM_SEARCH_ENGINE_ID"]
 
-CONFIG_PATH = "./config/config.json"
+# ログの設定. DEBUGにすると入出力のメッセージをすべて出力する(LOG_DEBUG_SAMPLE_RATEの割合で間引く)
+LOG_LEVEL = os.environ.get("LLM_SERVER_LOG_LEVEL", "INFO")
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LLM_SERVER_LOG_DEBUG_SAMPLE_RATE", "1.0"))
+
+# サイドカー構成(run_mcp_sidecars.py)で起動する場合は生成された設定ファイルを環境変数で指定する
+CONFIG_PATH = os.environ.get("LLM_SERVER_CONFIG", "./config/config.json")
+
+# 設定ファイルの変更を監視する間隔(Noneで監視しない)
+# 追加/変更されたサーバだけを起動し, 削除されたサーバは古いagentを使っているリクエストが終わってから止める
+CONFIG_RELOAD_INTERVAL_SEC: float | None = 2.0
+CONFIG_RELOAD_DRAIN_TIMEOUT_SEC = 300.0
+
+# LLMに送る会話履歴のトークン数の予算(目安). 古いターンから落とし, 大きなtoolの出力は途中を省略する
+# CONTEXT_SUMMARY_ENABLEDにすると落としたターンをLLMで要約してsystem messageに含める
+CONTEXT_MAX_TOKENS = 8000
+CONTEXT_MAX_TOOL_OUTPUT_TOKENS = 2000
+CONTEXT_SUMMARY_ENABLED = False
+
+# 1リクエストでagentを実行する時間の上限. tool呼び出しのタイムアウトもこの期限を超えない
+# (tool呼び出しごとのタイムアウトはmcp_servers.MCP_TOOL_TIMEOUT_SECかconfigの"toolTimeout")
+REQUEST_TIMEOUT_SEC = 300.0
+
+# 会話セッションの設定
+# SESSION_STORAGE_DIRを指定するとセッションをjsonファイルにも保存する
+# 複数ワーカーで起動する場合はワーカー間で会話履歴を共有するために指定する
+SESSION_MAX_SIZE = 1000
+SESSION_TTL_SEC = 60 * 60
+SESSION_STORAGE_DIR: str | None = os.environ.get("LLM_SERVER_SESSION_DIR")
+# 期限切れのセッション(とファイル)を消す間隔
+SESSION_SWEEP_INTERVAL_SEC = 10 * 60
+
+# 冪等なtoolの結果キャッシュ(tool名 -> TTL秒)
+# run_commandなど副作用のあるtoolはここに書いてもキャッシュされない
+# ページの取得(get_url_contentsなど)はMCPサーバ側でCache-Controlに従ってキャッシュするのでここには書かない
+TOOL_CACHE_TTLS: dict[str, float] = {
+  "search_and_pickup_top_results": 10 * 60,
+}
+TOOL_CACHE_MAX_ENTRIES = 1000
+
+# 似た質問への回答を使い回すキャッシュ(埋め込みのcos類似度がしきい値以上ならLLMを呼ばずに返す)
+# 文脈に依存する質問で別の会話の回答を返さないように, 既定では会話の最初の質問だけを対象にする
+RESPONSE_CACHE_ENABLED = os.environ.get("LLM_SERVER_RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_THRESHOLD = 0.95
+RESPONSE_CACHE_MAX_ENTRIES = 500
+RESPONSE_CACHE_TTL_SEC = 24 * 60 * 60
+RESPONSE_CACHE_FIRST_TURN_ONLY = True
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# クエリに関連するtop_k個のtoolだけをbindする(toolの定義はプロンプトの大きな部分を占めるため)
+# 既定ではtoolの名前と説明のBM25(英語のstopwordは除く)で選び, 関連するtoolが無い場合はすべてのtoolを使う
+# 一番関連度が高いtoolのTOOL_SELECTION_MIN_RELATIVE_SCORE倍に満たないtoolは偶然の一致とみなして選ばない
+# TOOL_SELECTION_USE_EMBEDDINGSにすると埋め込み(EMBEDDING_MODEL)のcos類似度で選ぶ
+TOOL_SELECTION_ENABLED = True
+TOOL_SELECTION_TOP_K = 3
+TOOL_SELECTION_ALWAYS_INCLUDE: set[str] = set()
+TOOL_SELECTION_MIN_SCORE = 0.0
+TOOL_SELECTION_MIN_RELATIVE_SCORE = 0.5
+TOOL_SELECTION_USE_EMBEDDINGS = False
+TOOL_SELECTION_MIN_SIMILARITY = 0.3
+# toolの組み合わせごとに作ったagentを保持する数
+AGENT_CACHE_SIZE = 32
+
+# /inferの同時実行数の制限
+# 同時実行数を超えたリクエストはキューで待たせ, キューがあふれる/待ち時間が長すぎる場合は503で断る
+# ADMISSION_MAX_PER_CLIENTを超えて同じクライアントから来たリクエストは429で断る(Noneで無制限)
+ADMISSION_MAX_CONCURRENCY = 4
+ADMISSION_MAX_QUEUE = 16
+ADMISSION_MAX_WAIT_SEC = 30.0
+ADMISSION_MAX_PER_CLIENT: int | None = 4
+
+# レスポンスのgzip圧縮(ストリーミングのエンドポイントは逐次送信のため対象外)
+RESPONSE_COMPRESSION = True
+GZIP_MINIMUM_SIZE = 1024
+
+# LLM呼び出しのヘッジ. 直近のレイテンシのLLM_HEDGE_PERCENTILEを過ぎても応答が無ければ同じリクエストをもう1つ送る
+# 追加で送るリクエストは呼び出し数のLLM_HEDGE_BUDGET_RATIOまでに制限する
+LLM_HEDGE_ENABLED = os.environ.get("LLM_SERVER_LLM_HEDGE", "0") == "1"
+LLM_HEDGE_PERCENTILE = 95.0
+LLM_HEDGE_MIN_DELAY_SEC = 0.5
+LLM_HEDGE_BUDGET_RATIO = 0.1
+
+# ベンチマーク用(benchmark/bench_infer.py). 指定するとGeminiの代わりに決まった順でtoolを呼ぶfakeのchat modelを使う
+FAKE_MODEL = bool(os.environ.get("LLM_SERVER_FAKE_MODEL"))
+FAKE_MODEL_LATENCY_SEC = float(os.environ.get("LLM_SERVER_FAKE_MODEL_LATENCY_SEC", "0.5"))
+FAKE_MODEL_SLOW_RATE = float(os.environ.get("LLM_SERVER_FAKE_MODEL_SLOW_RATE", "0"))
+FAKE_MODEL_SLOW_LATENCY_SEC = float(os.environ.get("LLM_SERVER_FAKE_MODEL_SLOW_LATENCY_SEC", "0"))
 
 
 TEMPERATUE = 0.5
@@ -33,104 +143,681 @@ SERVER_SCRIPT = "./led_emotional_mcp_server.py"
 
 
 class UserInput(BaseModel):
+  # 今回のユーザ入力のみ. 過去の履歴はsession_idでサーバ側から引く
   message: str
+  session_id: str | None = None
+  # 新規セッション作成時に先頭に置くsystem message
+  system_prompt: str | None = None
 
 
-app = FastAPI()
+class InferResponse(BaseModel):
+  session_id: str
+  # 今回のターンで増えたメッセージ(messages_to_dictの形式)
+  messages: list[dict[str, Any]]
 
-exit_stack = AsyncExitStack()
-agent = None
-model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", temperature=TEMPERATUE)
-tools = []
-resources = []
 
+class ToolsResponse(BaseModel):
+  # toolの組み合わせ(名前と説明)が変わったときだけ変わる. ETagヘッダにも同じ値を入れる
+  version: str
+  tools: dict[str, str]
 
-@app.on_event("startup")
-async def startup_event():
-  global exit_stack, agent, tools, resources
 
-  with open(CONFIG_PATH) as f:
-    config_data = json.load(f)
-  mcp_servers = config_data["mcpServers"]
-
-  await exit_stack.__aenter__()
-  print("MCP server initializing")
-  for server_name, server_info in mcp_servers.items():
-    print(f"--------------- {server_name} ---------------")
-
-    if "env" in server_info:
-      env = {k: os.environ[v] for k, v in server_info["env"].items()}
-    else:
-      env = {}
-
-    server_params = StdioServerParameters(
-      command=server_info["command"],
-      args=server_info["args"],
-      env=env,
-    )
-    read_stream, write_stream = await exit_stack.enter_async_context(stdio_client(server_params))
-    session = await exit_stack.enter_async_context(ClientSession(read_stream, write_stream))
+class NonStreamingGZipMiddleware(GZipMiddleware):
+  # gzipはチャンクをバッファリングしてしまうのでストリーミングのレスポンスは圧縮しない
+  async def __call__(self, scope, receive, send) -> None:
+    if scope["type"] == "http" and scope["path"].endswith("/stream"):
+      await self.app(scope, receive, send)
+      return
+    await super().__call__(scope, receive, send)
 
-    await session.initialize()
 
-    server_tools = await load_mcp_tools(session)
-    print("<Available tools>")
-    for tool in server_tools:
-      print(f" - {tool.name}: {tool.description}")
-      tools.append(tool)
+class ReleasingStreamingResponse(StreamingResponse):
+  # クライアントが先に切断していると本文のジェネレータが開始されずにキャンセルされることがあるので,
+  # ジェネレータのfinallyではなくレスポンスの送信が終わったとき(中断を含む)に必ずon_closeを呼ぶ
+  def __init__(self, content: AsyncIterator[bytes], on_close: Callable[[], None], **kwargs: Any) -> None:
+    super().__init__(content, **kwargs)
+    self.on_close = on_close
 
-    server_resources = await load_mcp_resources(session)
-    print("<Available resources>")
-    for resource in server_resources:
-      print(f" - {resource.data}, {resource.mimetype}, {resource.metadata}")
-      resources.append(resource)
+  async def __call__(self, scope, receive, send) -> None:
+    try:
+      await super().__call__(scope, receive, send)
+    finally:
+      self.on_close()
 
-  agent = create_react_agent(model, tools)
 
+logger = setup_logging("llm_server", LOG_LEVEL, LOG_DEBUG_SAMPLE_RATE)
 
-@app.on_event("shutdown")
-async def shutdown():
-  global exit_stack
-  await exit_stack.__aexit__(None, None, None)
+app = FastAPI(default_response_class=ORJSONResponse)
+if RESPONSE_COMPRESSION:
+  app.add_middleware(NonStreamingGZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
 
+agent = None
+if FAKE_MODEL:
+  from benchmark.fake_chat_model import ScriptedChatModel
+
+  model = ScriptedChatModel(
+    latency_sec=FAKE_MODEL_LATENCY_SEC,
+    slow_rate=FAKE_MODEL_SLOW_RATE,
+    slow_latency_sec=FAKE_MODEL_SLOW_LATENCY_SEC,
+  )
+else:
+  model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", temperature=TEMPERATUE)
+if LLM_HEDGE_ENABLED:
+  model = HedgedChatModel(
+    model=model,
+    percentile=LLM_HEDGE_PERCENTILE,
+    min_delay_sec=LLM_HEDGE_MIN_DELAY_SEC,
+    budget_ratio=LLM_HEDGE_BUDGET_RATIO,
+  )
+tools = []
+resources = []
+mcp_servers: dict[str, McpServer] = {}
+# 設定の再読み込みで差し替えたagentの世代と, 世代ごとの実行中のリクエスト数
+agent_generation = 0
+agent_users: Counter[int] = Counter()
+config_mtime: float | None = None
+config_reload_task: asyncio.Task | None = None
+session_sweep_task: asyncio.Task | None = None
+retiring_servers: list[McpServer] = []
+tool_index = ToolIndex([])
+tools_version = ""
+# 選んだtoolの組み合わせ -> agent(LRU). すべてのtoolを使う場合はagentを使う
+agents: OrderedDict[tuple[str, ...], Any] = OrderedDict()
+tool_cache = ToolResultCache(TOOL_CACHE_TTLS, max_entries=TOOL_CACHE_MAX_ENTRIES)
+admission = AdmissionController(
+  max_concurrency=ADMISSION_MAX_CONCURRENCY,
+  max_queue=ADMISSION_MAX_QUEUE,
+  max_wait_sec=ADMISSION_MAX_WAIT_SEC,
+  max_per_client=ADMISSION_MAX_PER_CLIENT,
+)
+# fakeのchat modelを使う場合は埋め込みもオフラインで動く決定的なもの(hashing_embedding)にする
+embed: EmbedFn | None = None
+if RESPONSE_CACHE_ENABLED or TOOL_SELECTION_USE_EMBEDDINGS:
+  embed = hashing_embedding if FAKE_MODEL else GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL).aembed_query
+response_cache: SemanticResponseCache | None = None
+if RESPONSE_CACHE_ENABLED:
+  assert embed is not None
+  response_cache = SemanticResponseCache(
+    embed,
+    threshold=RESPONSE_CACHE_THRESHOLD,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_sec=RESPONSE_CACHE_TTL_SEC,
+  )
+sessions = SessionStore(max_sessions=SESSION_MAX_SIZE, ttl_sec=SESSION_TTL_SEC, storage_dir=SESSION_STORAGE_DIR)
+context_budget = ContextBudget(CONTEXT_MAX_TOKENS, CONTEXT_MAX_TOOL_OUTPUT_TOKENS)
+background_tasks: set[asyncio.Task] = set()
+
+
+ADMISSION_WAIT_SECONDS = REGISTRY.register(
+  Histogram("llm_server_admission_wait_seconds", "Time a request waited in the admission queue.")
+)
+TOOL_SCHEMA_TOKENS = REGISTRY.register(
+  Histogram(
+    "llm_server_tool_schema_tokens",
+    "Estimated prompt tokens of tool definitions per request, for the selected tools and for all tools.",
+    ("set",),
+    TOKEN_BUCKETS,
+  )
+)
+CONTEXT_TOKENS = REGISTRY.register(
+  Histogram(
+    "llm_server_context_tokens",
+    "Estimated tokens of the messages sent to the chat model per call.",
+    buckets=TOKEN_BUCKETS,
+  )
+)
+REGISTRY.register(
+  Gauge(
+    "llm_server_admission_requests",
+    "Requests currently running or waiting for admission.",
+    lambda: {("active",): admission.active, ("queued",): admission.queue_depth},
+    ("state",),
+  )
+)
+REGISTRY.register(
+  Gauge(
+    "llm_server_tool_cache_lookups",
+    "Tool result cache lookups.",
+    lambda: {
+      **{(name, "hit"): count for name, count in tool_cache.hits.items()},
+      **{(name, "miss"): count for name, count in tool_cache.misses.items()},
+    },
+    ("tool", "result"),
+  )
+)
+REGISTRY.register(
+  Gauge(
+    "llm_server_response_cache_lookups",
+    "Semantic response cache lookups.",
+    lambda: (
+      {}
+      if response_cache is None
+      else {("hit",): response_cache.hits, ("miss",): response_cache.lookups - response_cache.hits}
+    ),
+    ("result",),
+  )
+)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, e: AdmissionRejected) -> ORJSONResponse:
+  logger.warning("request rejected", extra={"status_code": e.status_code, "reason": e.reason})
+  return ORJSONResponse(
+    {"detail": e.reason},
+    status_code=e.status_code,
+    headers={"Retry-After": str(e.retry_after)},
+  )
 
-@app.post("/infer")
-async def infer(input_data: UserInput):
-  global agent
 
-  print("=============================================")
-  # ユーザからの入力はAPI経由でjsonでくるのでlangchainのメッセージオブジェクトに変換
-  messages = messages_from_dict(json.loads(input_data.message))
+@app.on_event("startup")
+async def startup_event():
+  global config_mtime, config_reload_task, session_sweep_task
 
-  print("---------- [infer server]: user input data from ui ----------")
-  for message in messages:
-    print(f"{message.__class__.__name__}: {message.content}")
+  config_mtime = os.path.getmtime(CONFIG_PATH)
+  with open(CONFIG_PATH) as f:
+    config_data = json.load(f)
+  await apply_config(config_data["mcpServers"])
 
-  agent_response = await agent.ainvoke({"messages": messages})
-  agent_response = agent_response["messages"]
+  if CONFIG_RELOAD_INTERVAL_SEC is not None:
+    config_reload_task = asyncio.create_task(watch_config())
+  session_sweep_task = asyncio.create_task(sweep_sessions())
 
-  print("---------- [infer server]: ai agent response ----------")
 
-  for message in agent_response:
-    # デバッグ表示のために形式を変換
-    if isinstance(message, ToolMessage):
-      try:
-        contents = ast.literal_eval(message.content)
-        contents = [json.loads(content) for content in contents]
-      except (SyntaxError, ValueError):
-        contents = message.content
-    else:
-      contents = message.content
+@app.on_event("shutdown")
+async def shutdown():
+  # 止めている途中のサーバは下でまとめて止める
+  tasks = [task for task in (config_reload_task, session_sweep_task, *background_tasks) if task is not None]
+  for task in tasks:
+    task.cancel()
+  await asyncio.gather(*tasks, return_exceptions=True)
+  await asyncio.gather(*(server.stop() for server in [*mcp_servers.values(), *retiring_servers]))
+
+
+async def sweep_sessions() -> None:
+  while True:
+    await asyncio.sleep(SESSION_SWEEP_INTERVAL_SEC)
+    sessions.sweep()
+    try:
+      removed = await asyncio.to_thread(sessions.sweep_storage)
+    except OSError as e:
+      logger.warning("failed to sweep sessions", extra={"error": repr(e)})
+      continue
+    if removed:
+      logger.info("expired sessions removed", extra={"removed": removed})
+
+
+async def watch_config() -> None:
+  global config_mtime
+
+  while True:
+    await asyncio.sleep(CONFIG_RELOAD_INTERVAL_SEC)
+    try:
+      mtime = os.path.getmtime(CONFIG_PATH)
+      if mtime == config_mtime:
+        continue
+      with open(CONFIG_PATH) as f:
+        config_data = json.load(f)
+      config_mtime = mtime
+    except (OSError, ValueError) as e:
+      # 書き込み途中などで読めない場合は今の設定のまま次の確認を待つ
+      logger.warning("failed to read config", extra={"path": CONFIG_PATH, "error": repr(e)})
+      continue
+
+    logger.info("config changed, reloading", extra={"path": CONFIG_PATH})
+    try:
+      await apply_config(config_data["mcpServers"])
+    except Exception:
+      logger.exception("failed to reload config")
+
+
+async def apply_config(server_configs: dict[str, dict[str, Any]]) -> None:
+  global agent, tools, resources, mcp_servers, agent_generation, tool_index, tools_version
+
+  # 設定が変わったサーバは削除 + 追加として扱う. 前回起動に失敗したサーバは起動し直す
+  removed = {name: server for name, server in mcp_servers.items() if server_configs.get(name) != server.info}
+  added = {name: info for name, info in server_configs.items() if name not in mcp_servers or name in removed}
+  if not removed and not added:
+    return
+
+  # サーバごとの起動時間の合計ではなく一番遅いサーバの起動時間で済むように並列に起動する
+  logger.info("MCP server initializing", extra={"servers": list(added)})
+  started = {server.name: server for server in await start_servers(added, tool_cache)}
+
+  servers: dict[str, McpServer] = {}
+  for name in server_configs:
+    if name in mcp_servers and name not in removed:
+      servers[name] = mcp_servers[name]
+      continue
+
+    server = started[name]
+    if server.error is not None:
+      logger.warning(
+        "MCP server failed to start, skipped",
+        extra={"server": server.name, "startup_time": server.startup_time, "error": server.error},
+      )
+      continue
+    servers[name] = server
+
+    logger.info(
+      "MCP server started",
+      extra={
+        "server": server.name,
+        "startup_time": server.startup_time,
+        "tools": [tool.name for tool in server.tools],
+        "resources": [str(resource.metadata.get("uri")) for resource in server.resources],
+      },
+    )
 
-    print(f"{message.__class__.__name__}: {contents}, {type(message)}")
+  new_tools = [tool for server in servers.values() for tool in server.tools]
+  new_index = await build_index(new_tools)
+
+  # awaitを挟まずにまとめて差し替えるので, 実行中のリクエストは古いagentのまま最後まで動く
+  mcp_servers = servers
+  tools = new_tools
+  resources = [resource for server in servers.values() for resource in server.resources]
+  tool_index = new_index
+  tools_version = make_tools_version(tools)
+  agents.clear()
+  agent = build_agent(tools)
+  agent_generation += 1
+
+  if removed:
+    # 実行中のリクエストが終わるのを待つ間も次の設定変更を反映できるように, 止めるのはバックグラウンドで行う
+    retiring_servers.extend(removed.values())
+    task = asyncio.create_task(retire_servers(list(removed.values()), agent_generation))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def retire_servers(servers: list[McpServer], generation: int) -> None:
+  # 古い世代のagentを使っているリクエストが無くなってから止める
+  deadline = time.monotonic() + CONFIG_RELOAD_DRAIN_TIMEOUT_SEC
+  while any(users and g < generation for g, users in agent_users.items()) and time.monotonic() < deadline:
+    await asyncio.sleep(0.1)
+
+  await asyncio.gather(*(server.stop() for server in servers))
+  for server in servers:
+    retiring_servers.remove(server)
+    logger.info("MCP server stopped", extra={"server": server.name})
+
+
+def make_tools_version(tools: list[BaseTool]) -> str:
+  data = orjson.dumps([[tool.name, tool.description] for tool in tools])
+  return hashlib.sha256(data).hexdigest()[:16]
+
+
+async def build_index(tools: list[BaseTool]) -> ToolIndex:
+  if TOOL_SELECTION_USE_EMBEDDINGS and embed is not None:
+    try:
+      return await build_tool_index(tools, embed)
+    except Exception as e:
+      logger.warning("failed to embed tools, fall back to BM25", extra={"error": repr(e)})
+  return await build_tool_index(tools)
+
+
+def build_agent(agent_tools: list[BaseTool]) -> Any:
+  # 1ステップの複数のtool呼び出しはToolNodeが並列に実行する. タイムアウトなどのエラーはjsonのToolMessageで返す
+  tool_node = ToolNode(agent_tools, handle_tool_errors=format_tool_error)
+  return create_react_agent(model, tool_node, pre_model_hook=fit_context)
+
+
+async def embed_query(agent_input: list[BaseMessage]) -> list[float] | None:
+  if not TOOL_SELECTION_ENABLED or tool_index.embeddings is None or embed is None:
+    return None
+  try:
+    return await embed(str(agent_input[-1].content))
+  except Exception as e:
+    logger.warning("failed to embed query, fall back to BM25", extra={"error": repr(e)})
+    return None
+
+
+def select_agent(agent_input: list[BaseMessage], query_embedding: list[float] | None) -> Any:
+  if not TOOL_SELECTION_ENABLED:
+    return agent
+
+  # 履歴で使われたtoolは続きの質問でも使えるように残す
+  used = {m.name for m in agent_input if isinstance(m, ToolMessage) and m.name}
+  if query_embedding is not None:
+    min_score, min_relative_score = TOOL_SELECTION_MIN_SIMILARITY, 0.0
+  else:
+    min_score, min_relative_score = TOOL_SELECTION_MIN_SCORE, TOOL_SELECTION_MIN_RELATIVE_SCORE
+  selected = tool_index.select(
+    str(agent_input[-1].content),
+    TOOL_SELECTION_TOP_K,
+    TOOL_SELECTION_ALWAYS_INCLUDE | used,
+    min_score,
+    query_embedding,
+    min_relative_score,
+  )
+  TOOL_SCHEMA_TOKENS.observe(sum(tool_index.schema_tokens[tool.name] for tool in selected), "selected")
+  TOOL_SCHEMA_TOKENS.observe(sum(tool_index.schema_tokens.values()), "all")
+  if len(selected) == len(tools):
+    return agent
+
+  key = tuple(tool.name for tool in selected)
+  selected_agent = agents.get(key)
+  if selected_agent is None:
+    selected_agent = agents[key] = build_agent(selected)
+    while len(agents) > AGENT_CACHE_SIZE:
+      agents.popitem(last=False)
+  agents.move_to_end(key)
+  return selected_agent
+
+
+@contextmanager
+def use_agent(agent_input: list[BaseMessage], query_embedding: list[float] | None = None) -> Iterator[Any]:
+  # クエリに関連するtoolだけをbindしたagentを選び, 実行中のリクエストが使っているagentの世代を数える
+  generation = agent_generation
+  selected_agent = select_agent(agent_input, query_embedding)
+  agent_users[generation] += 1
+  try:
+    yield selected_agent
+  finally:
+    agent_users[generation] -= 1
+    if not agent_users[generation]:
+      del agent_users[generation]
+
+
+@app.post("/infer", response_model=InferResponse)
+async def infer(input_data: UserInput, request: Request) -> ORJSONResponse:
+  request_start = time.perf_counter()
+  session = get_or_create_session(input_data)
+  metrics_handler = MetricsCallbackHandler()
+
+  async with admission.admit(get_client_id(request)):
+    ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - request_start)
+    async with session.lock:
+      agent_input = build_agent_input(session, input_data.message)
+
+      logger.info("infer request", extra={"session_id": session.session_id, "history_size": len(agent_input)})
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("agent input\n%s", MessagesView(agent_input))
+
+      cached_message, cache_key = await lookup_response_cache(session, agent_input)
+      if cached_message is not None:
+        logger.info("response cache hit", extra={"session_id": session.session_id})
+        agent_messages = agent_input + [cached_message]
+      else:
+        query_embedding = await embed_query(agent_input)
+        request_deadline.set(time.monotonic() + REQUEST_TIMEOUT_SEC)
+        try:
+          with use_agent(agent_input, query_embedding) as current_agent:
+            async with asyncio.timeout(REQUEST_TIMEOUT_SEC):
+              agent_response = await current_agent.ainvoke(
+                {"messages": agent_input}, config={"callbacks": [metrics_handler]}
+              )
+        except TimeoutError:
+          logger.warning("agent timed out", extra={"session_id": session.session_id})
+          raise HTTPException(status_code=504, detail=f"agent did not finish in {REQUEST_TIMEOUT_SEC}s") from None
+        agent_messages = agent_response["messages"]
+        store_response_cache(cache_key, agent_messages[len(agent_input) :])
+      new_messages = finish_turn(session, agent_input, agent_messages)
+
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug("agent response\n%s", MessagesView(new_messages))
 
   # langchainのinvokeで得たデータはメッセージオブジェクトなのでjsonに変換
-  json_data = messages_to_dict(agent_response)
-  json_str = json.dumps(json_data, indent=2)
-  return {"response": json_str}
-
+  # 返すのは今回のターンで増えたメッセージのみ
+  # 大きなtoolの出力を二重にエンコード/検証しないようにorjsonで一度だけエンコードする
+  start = time.perf_counter()
+  response = ORJSONResponse({"session_id": session.session_id, "messages": messages_to_dict(new_messages)})
+  elapsed = time.perf_counter() - start
+  SERIALIZATION_SECONDS.observe(elapsed, "encode_response")
+  response.headers["Server-Timing"] = f"serialize;dur={elapsed * 1000:.2f}"
+
+  metrics_handler.record_request()
+  REQUEST_SECONDS.observe(time.perf_counter() - request_start, "/infer")
+  return response
+
+
+@app.post("/infer/stream")
+async def infer_stream(input_data: UserInput, request: Request) -> StreamingResponse:
+  session = get_or_create_session(input_data)
+
+  # 断る場合はステータスコードで返したいので, ストリーミングを始める前に受け付けを行う
+  client_id = get_client_id(request)
+  request_start = time.perf_counter()
+  await admission.acquire(client_id)
+  start = time.perf_counter()
+  ADMISSION_WAIT_SECONDS.observe(start - request_start)
+  metrics_handler = MetricsCallbackHandler()
+
+  # 1行1イベントのNDJSONで返す
+  # type: token / tool_start / tool_end / messages / error
+  async def event_stream() -> AsyncIterator[bytes]:
+    async with session.lock:
+      agent_input = build_agent_input(session, input_data.message)
+
+      logger.info("infer stream request", extra={"session_id": session.session_id, "history_size": len(agent_input)})
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("agent input\n%s", MessagesView(agent_input))
 
-@app.get("/tools")
-def get_tools() -> dict[str, str]:
-  _tools = {tool.name: tool.description for tool in tools}
-  return {"tools": json.dumps(_tools, indent=2)}
+      try:
+        cached_message, cache_key = await lookup_response_cache(session, agent_input)
+        if cached_message is not None:
+          logger.info("response cache hit", extra={"session_id": session.session_id})
+          new_messages = finish_turn(session, agent_input, agent_input + [cached_message])
+          yield to_ndjson({"type": "token", "content": cached_message.content})
+          yield to_ndjson(
+            {"type": "messages", "session_id": session.session_id, "messages": messages_to_dict(new_messages)}
+          )
+          return
+
+        query_embedding = await embed_query(agent_input)
+        request_deadline.set(time.monotonic() + REQUEST_TIMEOUT_SEC)
+        with use_agent(agent_input, query_embedding) as current_agent:
+          async with asyncio.timeout(REQUEST_TIMEOUT_SEC):
+            async for event in current_agent.astream_events(
+              {"messages": agent_input}, config={"callbacks": [metrics_handler]}, version="v2"
+            ):
+              kind = event["event"]
+              if kind == "on_chat_model_stream":
+                text = chunk_text(event["data"]["chunk"].content)
+                if text:
+                  yield to_ndjson({"type": "token", "content": text})
+              elif kind == "on_tool_start":
+                yield to_ndjson(
+                  {
+                    "type": "tool_start",
+                    "run_id": event["run_id"],
+                    "name": event["name"],
+                    "input": event["data"].get("input"),
+                  }
+                )
+              elif kind == "on_tool_end":
+                output = event["data"].get("output")
+                content = output.content if isinstance(output, BaseMessage) else str(output)
+                yield to_ndjson(
+                  {
+                    "type": "tool_end",
+                    "run_id": event["run_id"],
+                    "name": event["name"],
+                    "output": content,
+                  }
+                )
+              elif kind == "on_chain_end" and not event["parent_ids"]:
+                # グラフ全体の終了イベントに最終的な会話履歴が入っている
+                agent_messages = event["data"]["output"]["messages"]
+                store_response_cache(cache_key, agent_messages[len(agent_input) :])
+                new_messages = finish_turn(session, agent_input, agent_messages)
+                if logger.isEnabledFor(logging.DEBUG):
+                  logger.debug("agent response\n%s", MessagesView(new_messages))
+                yield to_ndjson(
+                  {"type": "messages", "session_id": session.session_id, "messages": messages_to_dict(new_messages)}
+                )
+      except TimeoutError:
+        logger.warning("agent timed out", extra={"session_id": session.session_id})
+        yield to_ndjson({"type": "error", "message": f"agent did not finish in {REQUEST_TIMEOUT_SEC}s"})
+      except Exception as e:
+        logger.exception("failed to stream agent response", extra={"session_id": session.session_id})
+        yield to_ndjson({"type": "error", "message": str(e)})
+
+  def finish() -> None:
+    admission.release(client_id, time.perf_counter() - start)
+    metrics_handler.record_request()
+    REQUEST_SECONDS.observe(time.perf_counter() - request_start, "/infer/stream")
+
+  return ReleasingStreamingResponse(event_stream(), on_close=finish, media_type="application/x-ndjson")
+
+
+def get_client_id(request: Request) -> str:
+  # クライアントごとの公平性のためのID. ヘッダで指定が無ければ接続元のアドレスを使う
+  if client_id := request.headers.get("X-Client-Id"):
+    return client_id
+  return request.client.host if request.client is not None else "unknown"
+
+
+def get_or_create_session(input_data: UserInput) -> Session:
+  if input_data.session_id is not None:
+    session = sessions.get(input_data.session_id)
+    if session is not None:
+      return session
+    logger.info("session not found or expired", extra={"session_id": input_data.session_id})
+
+  messages: list[BaseMessage] = []
+  if input_data.system_prompt:
+    messages.append(SystemMessage(content=input_data.system_prompt))
+  return sessions.create(messages)
+
+
+def split_history(session: Session) -> tuple[list[BaseMessage], list[BaseMessage]]:
+  # (先頭のsystem message, 要約済みのメッセージを除いた履歴)
+  messages = session.messages
+  system = messages[:1] if messages and isinstance(messages[0], SystemMessage) else []
+  return system, messages[len(system) + session.summarized_count :]
+
+
+def build_agent_input(session: Session, user_message: str) -> list[BaseMessage]:
+  # すべての履歴を送ると推論に時間がかかるのでトークン数の予算に収まる直近のターンを使う
+  # 先頭のsystem message(+ 古いターンの要約)は必ず残す
+  system, history = split_history(session)
+  return context_budget.fit(with_summary(system, session.summary) + history + [HumanMessage(content=user_message)])
+
+
+def fit_context(state: dict[str, Any]) -> dict[str, Any]:
+  # agentのLLM呼び出しごとに, そのターンで増えたtoolの出力も含めて予算に収める(グラフの状態は変えない)
+  messages = context_budget.fit(state["messages"])
+  CONTEXT_TOKENS.observe(context_budget.tokens(messages))
+  return {"llm_input_messages": messages}
+
+
+def finish_turn(
+  session: Session, agent_input: list[BaseMessage], agent_response: list[BaseMessage]
+) -> list[BaseMessage]:
+  # agentの出力は入力 + 今回生成されたメッセージなので差分だけを履歴に追加する
+  user_message = agent_input[-1]
+  new_messages = agent_response[len(agent_input) :]
+  session.messages = session.messages + [user_message] + new_messages
+  with SERIALIZATION_SECONDS.time("save_session"):
+    sessions.save(session)
+
+  if CONTEXT_SUMMARY_ENABLED:
+    # 応答を遅らせないように要約はバックグラウンドで行う(次のリクエストとはsession.lockで排他する)
+    task = asyncio.create_task(update_summary(session))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+  return new_messages
+
+
+async def update_summary(session: Session) -> None:
+  async with session.lock:
+    system, history = split_history(session)
+    dropped = context_budget.dropped_count(with_summary(system, session.summary) + history)
+    if not dropped:
+      return
+    try:
+      session.summary = await summarize(model, session.summary, history[:dropped], CONTEXT_MAX_TOOL_OUTPUT_TOKENS)
+    except Exception as e:
+      logger.warning("failed to update summary", extra={"session_id": session.session_id, "error": repr(e)})
+      return
+    session.summarized_count += dropped
+    sessions.save(session)
+  logger.info("summary updated", extra={"session_id": session.session_id, "summarized_count": session.summarized_count})
+
+
+async def lookup_response_cache(
+  session: Session, agent_input: list[BaseMessage]
+) -> tuple[AIMessage | None, tuple[str, str, list[float]] | None]:
+  # キャッシュにヒットすればその回答を, しなければ保存用のキー(scope, 質問, 埋め込み)を返す
+  if response_cache is None:
+    return None, None
+  if RESPONSE_CACHE_FIRST_TURN_ONLY and any(isinstance(m, HumanMessage) for m in session.messages):
+    return None, None
+
+  question = agent_input[-1].content
+  system_prompt = agent_input[0].content if isinstance(agent_input[0], SystemMessage) else ""
+  scope = make_scope(system_prompt, [tool.name for tool in tools])
+  try:
+    answer, embedding = await response_cache.lookup(scope, question)
+  except Exception as e:
+    logger.warning("failed to lookup response cache", extra={"error": repr(e)})
+    return None, None
+
+  if answer is None:
+    return None, (scope, question, embedding)
+  return AIMessage(content=answer), None
+
+
+def store_response_cache(cache_key: tuple[str, str, list[float]] | None, new_messages: list[BaseMessage]) -> None:
+  if response_cache is None or cache_key is None or not new_messages:
+    return
+  # 副作用のあるtoolを使った回答は毎回実行しないといけないのでキャッシュしない
+  if any(isinstance(m, ToolMessage) and m.name in NEVER_CACHE_TOOLS for m in new_messages):
+    return
+  answer = new_messages[-1]
+  if (
+    not isinstance(answer, AIMessage) or answer.tool_calls or not isinstance(answer.content, str) or not answer.content
+  ):
+    return
+  response_cache.store(*cache_key, answer.content)
+
+
+def chunk_text(content: str | list[Any]) -> str:
+  # geminiのチャンクは文字列またはpartのリストで来る
+  if isinstance(content, str):
+    return content
+  texts = []
+  for part in content:
+    if isinstance(part, str):
+      texts.append(part)
+    elif isinstance(part, dict) and part.get("type") == "text":
+      texts.append(part.get("text", ""))
+  return "".join(texts)
+
+
+def to_ndjson(event: dict[str, Any]) -> bytes:
+  with SERIALIZATION_SECONDS.time("encode_stream_event"):
+    return orjson.dumps(event, default=str, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+
+
+@app.get("/servers")
+def get_servers() -> dict[str, dict[str, Any]]:
+  return {name: server.status() for name, server in mcp_servers.items()}
+
+
+@app.get("/metrics")
+def get_metrics() -> PlainTextResponse:
+  # Prometheusのテキスト形式. 集計はここが呼ばれたときだけ行う
+  return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+def get_stats() -> dict[str, Any]:
+  stats = {"admission": admission.stats(), "tool_cache": tool_cache.stats()}
+  if response_cache is not None:
+    stats["response_cache"] = response_cache.stats()
+  if isinstance(model, HedgedChatModel):
+    stats["llm_hedge"] = model.stats()
+  return stats
+
+
+@app.get("/tools", response_model=ToolsResponse)
+def get_tools(request: Request) -> Response:
+  # UIは毎回のrerunで呼ぶので, If-None-Matchが今のバージョンと同じなら中身を返さずに304を返す
+  etag = f'"{tools_version}"'
+  headers = {"ETag": etag, "Cache-Control": "no-cache"}
+  if request.headers.get("If-None-Match") == etag:
+    return Response(status_code=304, headers=headers)
+  return ORJSONResponse(
+    {"version": tools_version, "tools": {tool.name: tool.description for tool in tools}}, headers=headers
+  )
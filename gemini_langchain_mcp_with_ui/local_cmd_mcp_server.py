@@ -1,11 +1,14 @@
+import asyncio
 import os
-import subprocess
+import signal
 
 from mcp.server.fastmcp import FastMCP
 from mcp.server.fastmcp.prompts import base
 
 mcp = FastMCP("terminal")
 DEFAULT_WORKSPACE = os.path.expanduser("./workspace")
+# コマンドの実行時間の上限. 超えたらコマンドを(子プロセスごと)止める
+COMMAND_TIMEOUT_SEC = float(os.environ.get("RUN_COMMAND_TIMEOUT_SEC", "120"))
 
 
 @mcp.tool()
@@ -22,9 +25,25 @@ async def run_command(command: str) -> str:
   Returns:
     The command output or an error message.
   """
+  # 時間のかかるコマンドが他のtool呼び出しを止めないように非同期で実行する
   try:
-    result = subprocess.run(command, shell=True, cwd=DEFAULT_WORKSPACE, capture_output=True, text=True)
-    return result.stdout or result.stderr
+    process = await asyncio.create_subprocess_shell(
+      command,
+      cwd=DEFAULT_WORKSPACE,
+      stdout=asyncio.subprocess.PIPE,
+      stderr=asyncio.subprocess.PIPE,
+      start_new_session=True,
+    )
+    try:
+      stdout, stderr = await asyncio.wait_for(process.communicate(), COMMAND_TIMEOUT_SEC)
+    except TimeoutError:
+      return f"command timed out after {COMMAND_TIMEOUT_SEC}s"
+    finally:
+      # タイムアウトやキャンセルで終わっていないコマンドを止める
+      if process.returncode is None:
+        os.killpg(process.pid, signal.SIGKILL)
+        await process.wait()
+    return stdout.decode(errors="replace") or stderr.decode(errors="replace")
   except Exception as e:
     return str(e)
 
@@ -59,4 +78,5 @@ def test() -> list[base.AssistantMessage | base.UserMessage]:
 
 
 if __name__ == "__main__":
-  mcp.run(transport="stdio")
+  # サイドカーとして起動する場合はMCP_TRANSPORT=sse, FASTMCP_HOST/FASTMCP_PORTで待ち受け先を指定する
+  mcp.run(transport=os.environ.get("MCP_TRANSPORT", "stdio"))
@@ -0,0 +1,91 @@
+import ast
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from typing import Any
+
+import orjson
+from langchain_core.messages import BaseMessage, ToolMessage
+
+# LogRecordの標準の属性. これ以外の属性はextraで渡された構造化フィールドとして出力する
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+  def format(self, record: logging.LogRecord) -> str:
+    data: dict[str, Any] = {
+      "time": self.formatTime(record),
+      "level": record.levelname,
+      "logger": record.name,
+      "message": record.getMessage(),
+    }
+    for key, value in vars(record).items():
+      if key not in _RECORD_ATTRS:
+        data[key] = value
+    if record.exc_info:
+      data["exc_info"] = self.formatException(record.exc_info)
+    return orjson.dumps(data, default=str).decode()
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+  # 既定のQueueHandlerは呼び出し元のスレッドでメッセージを文字列化してしまうので,
+  # 文字列化(ToolMessageのデコードなど)はリスナーのスレッドで行うようにそのままキューに入れる
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    return record
+
+
+class SamplingFilter(logging.Filter):
+  # DEBUGのログだけをsample_rateの割合で間引く
+  def __init__(self, sample_rate: float) -> None:
+    super().__init__()
+    self.sample_rate = sample_rate
+
+  def filter(self, record: logging.LogRecord) -> bool:
+    return record.levelno > logging.DEBUG or random.random() < self.sample_rate
+
+
+class MessagesView:
+  """
+  デバッグ表示用のメッセージ一覧.
+  ToolMessageのデコードは文字列化されるとき(=ログが実際に出力されるとき)まで行わない.
+  """
+
+  def __init__(self, messages: list[BaseMessage]) -> None:
+    self.messages = messages
+
+  def __str__(self) -> str:
+    lines = []
+    for message in self.messages:
+      # デバッグ表示のために形式を変換
+      if isinstance(message, ToolMessage):
+        try:
+          contents = ast.literal_eval(message.content)
+          contents = [json.loads(content) for content in contents]
+        except (SyntaxError, ValueError):
+          contents = message.content
+      else:
+        contents = message.content
+      lines.append(f"{message.__class__.__name__}: {contents}")
+    return "\n".join(lines)
+
+
+def setup_logging(name: str, level: str = "INFO", debug_sample_rate: float = 1.0) -> logging.Logger:
+  # ログの書き出しはイベントループをブロックしないように別スレッドのリスナーで行う
+  log_queue: queue.SimpleQueue = queue.SimpleQueue()
+  stream_handler = logging.StreamHandler()
+  stream_handler.setFormatter(JsonFormatter())
+  listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+  listener.start()
+  atexit.register(listener.stop)
+
+  queue_handler = DeferredQueueHandler(log_queue)
+  queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+
+  logger = logging.getLogger(name)
+  logger.setLevel(level)
+  logger.addHandler(queue_handler)
+  logger.propagate = False
+  return logger
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import time
+from contextlib import AbstractAsyncContextManager, AsyncExitStack
+from contextvars import ContextVar
+from typing import Any
+
+import orjson
+from langchain_core.documents.base import Blob
+from langchain_core.tools import BaseTool, ToolException
+from langchain_mcp_adapters.resources import load_mcp_resources
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.sse import sse_client
+from mcp.client.stdio import stdio_client
+from mcp.types import CallToolResult
+from mcp.types import Tool as MCPTool
+
+from metrics import TOOL_CALL_SECONDS, TOOL_TIMEOUTS
+from tool_cache import CachedSession, ToolResultCache
+
+MCP_SERVER_STARTUP_TIMEOUT_SEC = 30.0
+# 1サーバあたりのセッション(プロセス)数. configの"poolSize"で上書きできる("auto"でCPUコア数)
+MCP_POOL_SIZE = 1
+# tool呼び出し1回あたりのタイムアウト. configの"toolTimeout"(秒, またはtool名 -> 秒)で上書きできる
+MCP_TOOL_TIMEOUT_SEC = 60.0
+
+# リクエスト全体の期限(time.monotonic()の値). tool呼び出しはこれを超えて待たない
+request_deadline: ContextVar[float | None] = ContextVar("request_deadline", default=None)
+
+
+class ToolTimeoutError(ToolException):
+  def __init__(self, server: str, tool: str, timeout: float) -> None:
+    super().__init__(f"tool '{tool}' of MCP server '{server}' timed out after {timeout:.1f}s")
+    self.server = server
+    self.tool = tool
+    self.timeout = timeout
+
+
+def format_tool_error(e: Exception) -> str:
+  # toolのエラーはLLMが判断できるようにjsonにしてToolMessageで返す(ToolNodeのhandle_tool_errors)
+  error: dict[str, Any] = {"error": "tool_error", "message": str(e)}
+  if isinstance(e, ToolTimeoutError):
+    error.update({"error": "timeout", "timeout_sec": round(e.timeout, 1)})
+  return orjson.dumps(error).decode()
+
+
+class McpConnection:
+  """
+  1つのMCPサーバプロセスとのセッションを専用のタスクで保持する.
+  stdio_clientなどのcontext managerは開いたタスクで閉じる必要があるので,
+  起動から終了までを1つのタスクの中で行う.
+  """
+
+  def __init__(self, info: dict[str, Any]) -> None:
+    self.info = info
+    self.session: ClientSession | None = None
+    self.tool_defs: list[MCPTool] = []
+    self.in_flight = 0
+    self.total_calls = 0
+    self.error: str | None = None
+    self._ready = asyncio.Event()
+    self._stop = asyncio.Event()
+    self._task: asyncio.Task | None = None
+
+  @property
+  def running(self) -> bool:
+    return self._ready.is_set() and self._task is not None and not self._task.done()
+
+  async def start(self, timeout: float) -> bool:
+    self._task = asyncio.create_task(self._run())
+    ready = asyncio.create_task(self._ready.wait())
+    done, _ = await asyncio.wait({self._task, ready}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    ready.cancel()
+
+    if self._ready.is_set():
+      return True
+
+    if self._task in done:
+      self.error = repr(self._task.exception())
+    else:
+      # 起動が終わらないサーバは待たずに切り捨てる
+      self.error = f"startup timed out after {timeout}s"
+      self._task.cancel()
+      await asyncio.gather(self._task, return_exceptions=True)
+    return False
+
+  async def stop(self) -> None:
+    if self._task is None:
+      return
+    self._stop.set()
+    await asyncio.gather(self._task, return_exceptions=True)
+
+  async def call_tool(self, name: str, arguments: dict[str, Any] | None = None) -> CallToolResult:
+    assert self.session is not None
+    self.in_flight += 1
+    self.total_calls += 1
+    try:
+      return await self.session.call_tool(name, arguments)
+    finally:
+      self.in_flight -= 1
+
+  def _transport(self) -> AbstractAsyncContextManager:
+    # "url"があれば起動済みのサーバ(サイドカー)にSSEで接続し, 無ければ子プロセスとして起動してstdioで接続する
+    if "url" in self.info:
+      return sse_client(self.info["url"])
+
+    if "env" in self.info:
+      env = {k: os.environ[v] for k, v in self.info["env"].items()}
+    else:
+      env = {}
+
+    server_params = StdioServerParameters(
+      command=self.info["command"],
+      args=self.info["args"],
+      env=env,
+    )
+    return stdio_client(server_params)
+
+  async def _run(self) -> None:
+    async with AsyncExitStack() as exit_stack:
+      read_stream, write_stream = await exit_stack.enter_async_context(self._transport())
+      session = await exit_stack.enter_async_context(ClientSession(read_stream, write_stream))
+
+      await session.initialize()
+
+      self.tool_defs = (await session.list_tools()).tools
+      self.session = session
+
+      self._ready.set()
+      await self._stop.wait()
+
+
+class McpServer:
+  """
+  1つのMCPサーバ設定に対するセッションのプール.
+  toolはプールに対して作るので, 同時に来たtool呼び出しは一番空いているセッションに振り分けられる.
+  """
+
+  def __init__(self, name: str, info: dict[str, Any], tool_cache: ToolResultCache | None = None) -> None:
+    self.name = name
+    self.info = info
+    self.tool_cache = tool_cache
+    self.connections: list[McpConnection] = []
+    self.tools: list[BaseTool] = []
+    self.resources: list[Blob] = []
+    self.startup_time: float | None = None
+    self.error: str | None = None
+
+  @property
+  def timeout(self) -> float:
+    return float(self.info.get("timeout", MCP_SERVER_STARTUP_TIMEOUT_SEC))
+
+  @property
+  def pool_size(self) -> int:
+    pool_size = self.info.get("poolSize", MCP_POOL_SIZE)
+    if pool_size == "auto":
+      return os.cpu_count() or 1
+    return max(1, int(pool_size))
+
+  @property
+  def running(self) -> bool:
+    return any(connection.running for connection in self.connections)
+
+  def tool_timeout(self, name: str) -> float:
+    timeout = self.info.get("toolTimeout", MCP_TOOL_TIMEOUT_SEC)
+    if isinstance(timeout, dict):
+      timeout = timeout.get(name, MCP_TOOL_TIMEOUT_SEC)
+    return float(timeout)
+
+  async def start(self) -> bool:
+    start = time.perf_counter()
+    connections = [McpConnection(self.info) for _ in range(self.pool_size)]
+    results = await asyncio.gather(*(connection.start(self.timeout) for connection in connections))
+    self.connections = [connection for connection, ok in zip(connections, results) if ok]
+
+    if not self.connections:
+      self.error = connections[0].error
+      self.startup_time = time.perf_counter() - start
+      return False
+
+    # tool/resourceの定義はどのセッションでも同じなので先頭のセッションから取得する
+    # resourceの読み込みも起動のタイムアウトの残り時間で打ち切る
+    remaining = max(0.0, self.timeout - (time.perf_counter() - start))
+    try:
+      self.resources = await asyncio.wait_for(load_mcp_resources(self.connections[0].session), remaining)
+    except TimeoutError:
+      self.error = f"loading resources timed out after {self.timeout}s"
+      await self.stop()
+      self.startup_time = time.perf_counter() - start
+      return False
+    except Exception as e:
+      self.error = repr(e)
+      await self.stop()
+      self.startup_time = time.perf_counter() - start
+      return False
+    session = self if self.tool_cache is None else CachedSession(self, self.tool_cache)
+    self.tools = [convert_mcp_tool_to_langchain_tool(session, tool) for tool in self.connections[0].tool_defs]
+    self.startup_time = time.perf_counter() - start
+    return True
+
+  async def stop(self) -> None:
+    await asyncio.gather(*(connection.stop() for connection in self.connections))
+
+  async def call_tool(self, name: str, arguments: dict[str, Any] | None = None) -> CallToolResult:
+    # 実行中の呼び出しが一番少ないセッションを使う
+    connections = [connection for connection in self.connections if connection.running]
+    if not connections:
+      raise RuntimeError(f"MCP server '{self.name}' has no running session")
+    connection = min(connections, key=lambda c: (c.in_flight, c.total_calls))
+
+    timeout = self.tool_timeout(name)
+    deadline = request_deadline.get()
+    if deadline is not None:
+      timeout = max(0.0, min(timeout, deadline - time.monotonic()))
+    with TOOL_CALL_SECONDS.time(self.name, name):
+      try:
+        return await asyncio.wait_for(connection.call_tool(name, arguments), timeout)
+      except TimeoutError:
+        # 待つのをやめるだけでサーバ側の処理は止まらない(mcpのクライアントはキャンセルを通知しない)
+        TOOL_TIMEOUTS.inc(1, self.name, name)
+        raise ToolTimeoutError(self.name, name, timeout) from None
+
+  def status(self) -> dict[str, Any]:
+    return {
+      "running": self.running,
+      "startup_time": self.startup_time,
+      "error": self.error,
+      "pool_size": len(self.connections),
+      "in_flight": [connection.in_flight for connection in self.connections],
+      "tools": [tool.name for tool in self.tools],
+    }
+
+
+async def start_servers(
+  mcp_servers: dict[str, dict[str, Any]], tool_cache: ToolResultCache | None = None
+) -> list[McpServer]:
+  # すべてのサーバを並列に起動する. 起動に失敗/タイムアウトしたサーバはerrorに理由が入る
+  servers = [McpServer(name, info, tool_cache) for name, info in mcp_servers.items()]
+  await asyncio.gather(*(server.start() for server in servers))
+  return servers
@@ -0,0 +1,193 @@
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+# Prometheusのテキスト形式で出力する軽量なメトリクス.
+# 記録時はバケットのカウンタを1つ増やすだけにして, 集計(累積和)は/metricsが読まれたときに行う.
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+  labels = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+  if extra:
+    labels.append(extra)
+  return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+  def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self._values: dict[tuple[str, ...], float] = {}
+
+  def inc(self, amount: float = 1.0, *labelvalues: str) -> None:
+    self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+  def render(self) -> list[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+    for labelvalues, value in self._values.items():
+      lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+    return lines
+
+
+class Histogram:
+  def __init__(
+    self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS
+  ) -> None:
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self.buckets = buckets
+    # ラベルの値 -> [各バケットの件数(累積ではない)..., +Infの件数], 合計
+    self._counts: dict[tuple[str, ...], list[int]] = {}
+    self._sums: dict[tuple[str, ...], float] = {}
+
+  def observe(self, value: float, *labelvalues: str) -> None:
+    counts = self._counts.get(labelvalues)
+    if counts is None:
+      counts = self._counts[labelvalues] = [0] * (len(self.buckets) + 1)
+      self._sums[labelvalues] = 0.0
+    counts[bisect_left(self.buckets, value)] += 1
+    self._sums[labelvalues] += value
+
+  def time(self, *labelvalues: str) -> "_Timer":
+    return _Timer(self, labelvalues)
+
+  def render(self) -> list[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+    for labelvalues, counts in self._counts.items():
+      total = 0
+      for bound, count in zip([*self.buckets, "+Inf"], counts):
+        total += count
+        le = 'le="' + str(bound) + '"'
+        lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {total}")
+      lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {self._sums[labelvalues]}")
+      lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues)} {total}")
+    return lines
+
+
+class Gauge:
+  # 値は/metricsが読まれたときにcallbackで取得する
+  def __init__(
+    self,
+    name: str,
+    help: str,
+    callback: Callable[[], dict[tuple[str, ...], float]],
+    labelnames: tuple[str, ...] = (),
+  ) -> None:
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self.callback = callback
+
+  def render(self) -> list[str]:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+    for labelvalues, value in self.callback().items():
+      lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+    return lines
+
+
+class _Timer:
+  def __init__(self, histogram: Histogram, labelvalues: tuple[str, ...]) -> None:
+    self.histogram = histogram
+    self.labelvalues = labelvalues
+
+  def __enter__(self) -> None:
+    self.start = time.perf_counter()
+
+  def __exit__(self, *_) -> None:
+    self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+
+class Registry:
+  def __init__(self) -> None:
+    self.metrics: list[Counter | Histogram | Gauge] = []
+
+  def register(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def render(self) -> str:
+    lines = []
+    for metric in self.metrics:
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(
+  Histogram("llm_server_request_seconds", "Total time to handle an inference request.", ("endpoint",))
+)
+LLM_CALL_SECONDS = REGISTRY.register(Histogram("llm_server_llm_call_seconds", "Latency of each chat model call."))
+LLM_HEDGE_EVENTS = REGISTRY.register(
+  Counter(
+    "llm_server_llm_hedge_events_total",
+    "Hedged chat model calls: call, hedged (duplicate fired), hedge_won, budget_exhausted.",
+    ("event",),
+  )
+)
+TOOL_CALL_SECONDS = REGISTRY.register(
+  Histogram(
+    "llm_server_tool_call_seconds",
+    "Latency of each MCP tool call measured at the client (includes MCP IPC).",
+    ("server", "tool"),
+  )
+)
+TOOL_TIMEOUTS = REGISTRY.register(
+  Counter("llm_server_tool_timeouts_total", "MCP tool calls that timed out.", ("server", "tool"))
+)
+SERIALIZATION_SECONDS = REGISTRY.register(
+  Histogram("llm_server_serialization_seconds", "Time spent (de)serializing messages.", ("operation",))
+)
+REQUEST_TOKENS = REGISTRY.register(
+  Histogram("llm_server_request_tokens", "Tokens used by the chat model per request.", ("type",), TOKEN_BUCKETS)
+)
+TOKENS_TOTAL = REGISTRY.register(Counter("llm_server_tokens_total", "Tokens used by the chat model.", ("type",)))
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+  """
+  LLM呼び出しごとのレイテンシとトークン数を記録する.
+  1リクエストごとに作り, リクエスト単位のトークン数も集計する.
+  """
+
+  # イベントループ上でそのまま実行する(スレッドプールに回さない)
+  run_inline = True
+
+  def __init__(self) -> None:
+    self.input_tokens = 0
+    self.output_tokens = 0
+    self._starts: dict[UUID, float] = {}
+
+  def on_chat_model_start(self, serialized: dict[str, Any], messages: Any, *, run_id: UUID, **kwargs: Any) -> None:
+    self._starts[run_id] = time.perf_counter()
+
+  def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+    start = self._starts.pop(run_id, None)
+    if start is not None:
+      LLM_CALL_SECONDS.observe(time.perf_counter() - start)
+
+    for generations in response.generations:
+      for generation in generations:
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if usage:
+          self.input_tokens += usage.get("input_tokens", 0)
+          self.output_tokens += usage.get("output_tokens", 0)
+
+  def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+    self._starts.pop(run_id, None)
+
+  def record_request(self) -> None:
+    REQUEST_TOKENS.observe(self.input_tokens, "input")
+    REQUEST_TOKENS.observe(self.output_tokens, "output")
+    TOKENS_TOTAL.inc(self.input_tokens, "input")
+    TOKENS_TOTAL.inc(self.output_tokens, "output")
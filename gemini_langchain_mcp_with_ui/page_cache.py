@@ -0,0 +1,192 @@
+import re
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+# Cache-ControlにもExpiresにも有効期限が無い場合, Last-Modifiedからの経過時間の10%を有効期限にする(RFC 9111 4.2.2)
+HEURISTIC_FRESHNESS_RATIO = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+  url TEXT PRIMARY KEY,
+  text TEXT NOT NULL,
+  etag TEXT,
+  last_modified TEXT,
+  expires_at REAL NOT NULL,
+  size INTEGER NOT NULL,
+  last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access);
+"""
+
+_DIRECTIVE_PATTERN = re.compile(r"([\w-]+)\s*(?:=\s*\"?([^\",]*)\"?)?")
+
+
+@dataclass
+class CachedPage:
+  url: str
+  # テキスト化済みのページの内容
+  text: str
+  etag: str | None
+  last_modified: str | None
+  expires_at: float
+
+  def is_fresh(self, now: float) -> bool:
+    return now < self.expires_at
+
+  def validators(self) -> dict[str, str]:
+    # 条件付きGETのヘッダ
+    headers = {}
+    if self.etag:
+      headers["If-None-Match"] = self.etag
+    if self.last_modified:
+      headers["If-Modified-Since"] = self.last_modified
+    return headers
+
+
+def parse_cache_control(value: str) -> dict[str, str | None]:
+  return {name.lower(): arg for name, arg in _DIRECTIVE_PATTERN.findall(value)}
+
+
+def parse_http_date(value: str | None) -> float | None:
+  if not value:
+    return None
+  try:
+    return parsedate_to_datetime(value).timestamp()
+  except (TypeError, ValueError):
+    return None
+
+
+def freshness_lifetime(headers: Mapping[str, str], now: float, max_ttl_sec: float) -> float | None:
+  """
+  レスポンスヘッダからキャッシュの有効期間(秒)を求める. 保存してはいけない場合はNone.
+  no-cacheの場合は0(毎回再検証する)になる.
+  """
+  directives = parse_cache_control(headers.get("cache-control", ""))
+  if "no-store" in directives:
+    return None
+  if "no-cache" in directives:
+    return 0.0
+
+  age = headers.get("age", "")
+  age_sec = float(age) if age.isdigit() else 0.0
+  max_age = directives.get("max-age")
+  if max_age is not None and max_age.isdigit():
+    lifetime = float(max_age)
+  elif (expires := parse_http_date(headers.get("expires"))) is not None:
+    date = parse_http_date(headers.get("date")) or now
+    lifetime = expires - date
+  elif (last_modified := parse_http_date(headers.get("last-modified"))) is not None:
+    date = parse_http_date(headers.get("date")) or now
+    lifetime = (date - last_modified) * HEURISTIC_FRESHNESS_RATIO
+  else:
+    lifetime = 0.0
+  return min(max_ttl_sec, max(0.0, lifetime - age_sec))
+
+
+class PageCache:
+  """
+  取得したページのテキストをURLをキーにしてSQLite(WAL)に保存するキャッシュ.
+  有効期限はCache-Control/Expiresに従い, 期限切れの場合はETag/Last-Modifiedで条件付きGETをして再検証する.
+  合計サイズがmax_bytesを超えたら最後に使われたのが古いものから消す.
+  """
+
+  def __init__(self, path: str, max_bytes: int, max_ttl_sec: float) -> None:
+    self.max_bytes = max_bytes
+    self.max_ttl_sec = max_ttl_sec
+    self.hits = 0
+    self.revalidated = 0
+    self.misses = 0
+    # 接続は1つをロックして共有する
+    self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._conn.execute("PRAGMA journal_mode=WAL")
+      self._conn.execute("PRAGMA synchronous=NORMAL")
+      self._conn.executescript(SCHEMA)
+
+  def get(self, url: str) -> CachedPage | None:
+    with self._lock:
+      row = self._conn.execute(
+        "SELECT text, etag, last_modified, expires_at FROM pages WHERE url = ?", (url,)
+      ).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      now = time.time()
+      self._conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (now, url))
+    page = CachedPage(url=url, text=row[0], etag=row[1], last_modified=row[2], expires_at=row[3])
+    # 期限切れ(再検証が必要)のものはmissとして数え, 304で再検証できた数はrevalidatedで別に数える
+    if page.is_fresh(now):
+      self.hits += 1
+    else:
+      self.misses += 1
+    return page
+
+  def put(self, url: str, text: str, headers: Mapping[str, str]) -> None:
+    now = time.time()
+    lifetime = freshness_lifetime(headers, now, self.max_ttl_sec)
+    etag = headers.get("etag")
+    last_modified = headers.get("last-modified")
+    # 保存禁止の場合と, 期限も再検証の手段も無く次回使えない場合は保存しない
+    if lifetime is None or (lifetime <= 0 and not etag and not last_modified):
+      self.delete(url)
+      return
+    size = len(text.encode())
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      self._conn.execute(
+        "INSERT OR REPLACE INTO pages (url, text, etag, last_modified, expires_at, size, last_access) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (url, text, etag, last_modified, now + lifetime, size, now),
+      )
+      self._evict()
+
+  def refresh(self, url: str, headers: Mapping[str, str]) -> None:
+    # 304 Not Modifiedを受け取った場合は内容はそのままで有効期限(と検証子)だけを更新する
+    self.revalidated += 1
+    now = time.time()
+    lifetime = freshness_lifetime(headers, now, self.max_ttl_sec)
+    if lifetime is None:
+      self.delete(url)
+      return
+    with self._lock:
+      self._conn.execute(
+        "UPDATE pages SET expires_at = ?, etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), "
+        "last_access = ? WHERE url = ?",
+        (now + lifetime, headers.get("etag"), headers.get("last-modified"), now, url),
+      )
+
+  def delete(self, url: str) -> None:
+    with self._lock:
+      self._conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+    return {
+      "hits": self.hits,
+      "revalidated": self.revalidated,
+      "misses": self.misses,
+      "entries": entries,
+      "bytes": size,
+    }
+
+  def _evict(self) -> None:
+    (total,) = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()
+    if total <= self.max_bytes:
+      return
+    # 最後に使われたのが古い順に, 合計がmax_bytes以下になるまで消す
+    excess = total - self.max_bytes
+    removed = 0
+    urls = []
+    for url, size in self._conn.execute("SELECT url, size FROM pages ORDER BY last_access"):
+      urls.append((url,))
+      removed += size
+      if removed >= excess:
+        break
+    self._conn.executemany("DELETE FROM pages WHERE url = ?", urls)
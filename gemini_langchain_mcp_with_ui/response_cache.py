@@ -0,0 +1,104 @@
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import Any
+
+# テキスト -> 埋め込みベクトル
+EmbedFn = Callable[[str], Awaitable[list[float]]]
+
+
+@dataclass
+class CachedResponse:
+  scope: str
+  question: str
+  embedding: list[float]
+  answer: str
+  expires_at: float
+
+
+class SemanticResponseCache:
+  """
+  ユーザの質問の埋め込みが過去の質問と十分に近ければ, そのときの回答をそのまま返すキャッシュ.
+  system promptとtoolの組み合わせ(scope)ごとに別のキャッシュとして扱う.
+  """
+
+  def __init__(
+    self, embed: EmbedFn, threshold: float = 0.95, max_entries: int = 500, ttl_sec: float = 24 * 60 * 60
+  ) -> None:
+    self.embed = embed
+    self.threshold = threshold
+    self.max_entries = max_entries
+    self.ttl_sec = ttl_sec
+    self.lookups = 0
+    self.hits = 0
+    self._entries: OrderedDict[int, CachedResponse] = OrderedDict()
+    self._next_id = 0
+
+  async def lookup(self, scope: str, question: str) -> tuple[str | None, list[float]]:
+    # 保存時に同じ埋め込みを使えるように埋め込みも返す
+    embedding = await self.embed(question)
+    self.lookups += 1
+
+    now = time.monotonic()
+    best_id, best_score = None, self.threshold
+    for entry_id, entry in list(self._entries.items()):
+      if entry.expires_at < now:
+        del self._entries[entry_id]
+        continue
+      if entry.scope != scope:
+        continue
+      score = cosine_similarity(embedding, entry.embedding)
+      if score >= best_score:
+        best_id, best_score = entry_id, score
+
+    if best_id is None:
+      return None, embedding
+
+    self.hits += 1
+    self._entries.move_to_end(best_id)
+    return self._entries[best_id].answer, embedding
+
+  def store(self, scope: str, question: str, embedding: list[float], answer: str) -> None:
+    self._entries[self._next_id] = CachedResponse(
+      scope=scope,
+      question=question,
+      embedding=embedding,
+      answer=answer,
+      expires_at=time.monotonic() + self.ttl_sec,
+    )
+    self._next_id += 1
+    # 最近ヒットしていないものから捨てる
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+
+  def stats(self) -> dict[str, Any]:
+    return {
+      "entries": len(self._entries),
+      "lookups": self.lookups,
+      "hits": self.hits,
+      "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+    }
+
+
+def make_scope(system_prompt: str, tool_names: list[str]) -> str:
+  key = system_prompt + "\0" + "\0".join(sorted(tool_names))
+  return hashlib.sha256(key.encode()).hexdigest()
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+  dot = sum(x * y for x, y in zip(a, b))
+  norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+  return dot / norm if norm else 0.0
+
+
+async def hashing_embedding(text: str, dim: int = 256) -> list[float]:
+  # オフラインで動かすための決定的な埋め込み(文字bigramをハッシュしてベクトル化)
+  vector = [0.0] * dim
+  text = text.strip().lower()
+  for i in range(max(1, len(text) - 1)):
+    digest = hashlib.md5(text[i : i + 2].encode()).digest()
+    vector[int.from_bytes(digest[:4], "little") % dim] += 1.0
+  return vector
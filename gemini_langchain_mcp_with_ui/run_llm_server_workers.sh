@@ -0,0 +1,16 @@
+#!/bin/bash
+
+# MCPサーバをサイドカーとして1つずつ起動し, 複数のuvicornワーカーから共有する
+WORKERS=${WORKERS:-4}
+SIDECAR_CONFIG=./config/sidecar_config.json
+
+rm -f $SIDECAR_CONFIG
+uv run python run_mcp_sidecars.py ./config/config.json $SIDECAR_CONFIG &
+SIDECAR_PID=$!
+trap "kill $SIDECAR_PID" EXIT
+
+while [ ! -f $SIDECAR_CONFIG ]; do
+  sleep 0.5
+done
+
+LLM_SERVER_CONFIG=$SIDECAR_CONFIG LLM_SERVER_SESSION_DIR=./sessions uv run uvicorn llm_server:app --workers $WORKERS
@@ -0,0 +1,88 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# config.jsonのMCPサーバをSSEで待ち受けるサイドカーとして1つずつ起動し,
+# 各サーバに"url"で接続する設定ファイルを書き出す.
+# uvicornを複数ワーカーで起動しても, MCPサーバのプロセスはワーカー数に関係なく1つで済む.
+#
+#   python run_mcp_sidecars.py [config.json] [sidecar_config.json]
+
+CONFIG_PATH = "./config/config.json"
+SIDECAR_CONFIG_PATH = "./config/sidecar_config.json"
+SIDECAR_HOST = "127.0.0.1"
+SIDECAR_BASE_PORT = 8100
+SIDECAR_STARTUP_TIMEOUT_SEC = 30.0
+
+
+def wait_for_port(host: str, port: int, timeout: float) -> bool:
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      with socket.create_connection((host, port), timeout=1):
+        return True
+    except OSError:
+      time.sleep(0.2)
+  return False
+
+
+def main(config_path: str, sidecar_config_path: str) -> None:
+  with open(config_path) as f:
+    config_data = json.load(f)
+
+  # 古い設定ファイルを読まれないように先に消しておく
+  if os.path.exists(sidecar_config_path):
+    os.remove(sidecar_config_path)
+
+  processes: list[subprocess.Popen] = []
+  sidecar_ports: dict[str, int] = {}
+  sidecar_servers = {}
+  for i, (server_name, server_info) in enumerate(config_data["mcpServers"].items()):
+    # すでにurlで指定されているサーバはそのまま使う
+    if "url" in server_info:
+      sidecar_servers[server_name] = server_info
+      continue
+
+    port = int(server_info.get("sidecarPort", SIDECAR_BASE_PORT + i))
+    env = dict(os.environ)
+    env.update({k: os.environ[v] for k, v in server_info.get("env", {}).items()})
+    env.update({"MCP_TRANSPORT": "sse", "FASTMCP_HOST": SIDECAR_HOST, "FASTMCP_PORT": str(port)})
+
+    print(f"start sidecar: {server_name} (port: {port})")
+    processes.append(subprocess.Popen([server_info["command"], *server_info["args"]], env=env))
+    sidecar_ports[server_name] = port
+
+    sidecar_info = {k: v for k, v in server_info.items() if k not in ("command", "args", "env", "sidecarPort")}
+    sidecar_info["url"] = f"http://{SIDECAR_HOST}:{port}/sse"
+    sidecar_servers[server_name] = sidecar_info
+
+  def shutdown(*_) -> None:
+    for process in processes:
+      process.terminate()
+    for process in processes:
+      process.wait()
+    sys.exit(0)
+
+  signal.signal(signal.SIGTERM, shutdown)
+  signal.signal(signal.SIGINT, shutdown)
+
+  for server_name, port in sidecar_ports.items():
+    if not wait_for_port(SIDECAR_HOST, port, SIDECAR_STARTUP_TIMEOUT_SEC):
+      print(f"sidecar did not start: {server_name}")
+
+  with open(sidecar_config_path, "w") as f:
+    json.dump({"mcpServers": sidecar_servers}, f, indent=2)
+  print(f"sidecar config written: {sidecar_config_path}")
+
+  for process in processes:
+    process.wait()
+
+
+if __name__ == "__main__":
+  config_path = sys.argv[1] if len(sys.argv) > 1 else CONFIG_PATH
+  sidecar_config_path = sys.argv[2] if len(sys.argv) > 2 else SIDECAR_CONFIG_PATH
+  main(config_path, sidecar_config_path)
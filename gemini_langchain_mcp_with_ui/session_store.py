@@ -0,0 +1,176 @@
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from langchain_core.messages import BaseMessage
+from langchain_core.messages.base import messages_to_dict
+from langchain_core.messages.utils import messages_from_dict
+
+SESSION_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+@dataclass
+class Session:
+  session_id: str
+  messages: list[BaseMessage] = field(default_factory=list)
+  last_access: float = field(default_factory=time.time)
+  # ディスクに保存されている内容の更新時刻. 他のプロセスが更新していたら読み直す
+  mtime: float = 0.0
+  lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+  # 古いターンの要約と, 要約済みのメッセージ数(先頭のsystem messageを除く)
+  summary: str = ""
+  summarized_count: int = 0
+
+
+class SessionStore:
+  """
+  会話履歴をサーバ側で保持するストア.
+  メモリ上はLRU + TTLで管理し, storage_dirを指定するとjsonファイルにも保存する.
+  """
+
+  def __init__(self, max_sessions: int = 1000, ttl_sec: float = 60 * 60, storage_dir: str | None = None) -> None:
+    self.max_sessions = max_sessions
+    self.ttl_sec = ttl_sec
+    self.storage_dir = storage_dir
+    self._sessions: OrderedDict[str, Session] = OrderedDict()
+
+    if self.storage_dir is not None:
+      os.makedirs(self.storage_dir, exist_ok=True)
+
+  def create(self, messages: list[BaseMessage] | None = None) -> Session:
+    session = Session(session_id=uuid.uuid4().hex, messages=list(messages or []))
+    self._put(session)
+    return session
+
+  def get(self, session_id: str) -> Session | None:
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+      return None
+
+    now = time.time()
+    session = self._sessions.get(session_id)
+    if session is None or self._modified_elsewhere(session):
+      loaded = self._load(session_id)
+      if loaded is None:
+        if session is None:
+          return None
+      else:
+        session = self._reload(session, loaded)
+      self._put(session)
+
+    if now - session.last_access > self.ttl_sec:
+      self.delete(session_id)
+      return None
+
+    session.last_access = now
+    self._sessions.move_to_end(session_id)
+    return session
+
+  def save(self, session: Session) -> None:
+    session.last_access = time.time()
+    self._put(session)
+
+    if self.storage_dir is None:
+      return
+    path = self._path(session.session_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+      data = {
+        "messages": messages_to_dict(session.messages),
+        "summary": session.summary,
+        "summarized_count": session.summarized_count,
+      }
+      json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    session.mtime = os.path.getmtime(path)
+
+  def delete(self, session_id: str) -> None:
+    self._sessions.pop(session_id, None)
+    if self.storage_dir is not None:
+      try:
+        os.remove(self._path(session_id))
+      except FileNotFoundError:
+        pass
+
+  def sweep(self) -> None:
+    # getはアクセスされたセッションしか期限を確認しないので, 期限切れのセッションを定期的にメモリから消す
+    now = time.time()
+    for session_id in [sid for sid, session in self._sessions.items() if now - session.last_access > self.ttl_sec]:
+      del self._sessions[session_id]
+
+  def sweep_storage(self) -> int:
+    # storage_dirから更新時刻がTTLを過ぎたファイルを消し, 消した数を返す. メモリ上のセッションには触らない
+    if self.storage_dir is None:
+      return 0
+    now = time.time()
+    removed = 0
+    with os.scandir(self.storage_dir) as entries:
+      for entry in entries:
+        session_id, ext = os.path.splitext(entry.name)
+        if ext != ".json" or not SESSION_ID_PATTERN.fullmatch(session_id):
+          continue
+        try:
+          if now - entry.stat().st_mtime > self.ttl_sec:
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+          # 他のワーカーが先に消した
+          pass
+    return removed
+
+  def _put(self, session: Session) -> None:
+    self._sessions[session.session_id] = session
+    self._sessions.move_to_end(session.session_id)
+    # メモリからあふれた分は古いものから捨てる(ディスクにあれば次回読み直す)
+    while len(self._sessions) > self.max_sessions:
+      self._sessions.popitem(last=False)
+
+  def _load(self, session_id: str) -> Session | None:
+    if self.storage_dir is None:
+      return None
+    path = self._path(session_id)
+    try:
+      last_access = os.path.getmtime(path)
+      with open(path) as f:
+        data = json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+      return None
+    # 要約を保存する前の形式(メッセージのリストのみ)も読めるようにする
+    if isinstance(data, list):
+      data = {"messages": data}
+    return Session(
+      session_id=session_id,
+      messages=messages_from_dict(data["messages"]),
+      last_access=last_access,
+      mtime=last_access,
+      summary=data.get("summary", ""),
+      summarized_count=data.get("summarized_count", 0),
+    )
+
+  def _modified_elsewhere(self, session: Session) -> bool:
+    # 複数のワーカープロセスで同じディレクトリを共有している場合に, 他のワーカーが書き込んだかを確認する
+    if self.storage_dir is None:
+      return False
+    try:
+      return os.path.getmtime(self._path(session.session_id)) > session.mtime
+    except FileNotFoundError:
+      return False
+
+  def _reload(self, session: Session | None, loaded: Session) -> Session:
+    # 処理中のリクエストとロックを共有できるように既存のSessionオブジェクトを更新する
+    if session is None:
+      return loaded
+    session.messages = loaded.messages
+    session.summary = loaded.summary
+    session.summarized_count = loaded.summarized_count
+    session.last_access = loaded.last_access
+    session.mtime = loaded.mtime
+    return session
+
+  def _path(self, session_id: str) -> str:
+    assert self.storage_dir is not None
+    return os.path.join(self.storage_dir, f"{session_id}.json")
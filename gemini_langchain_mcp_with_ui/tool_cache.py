@@ -0,0 +1,87 @@
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from mcp.types import CallToolResult
+
+# 副作用があるtoolは設定に関わらず絶対にキャッシュしない
+NEVER_CACHE_TOOLS = {"run_command", "emotional_led_matrix"}
+
+
+@dataclass
+class CacheEntry:
+  result: CallToolResult
+  expires_at: float
+
+
+class ToolResultCache:
+  """
+  冪等なtoolの呼び出し結果をtool名 + 引数をキーにしてキャッシュする.
+  キャッシュするtoolとTTLはttls(tool名 -> 秒)で個別に指定する.
+  """
+
+  def __init__(self, ttls: dict[str, float], max_entries: int = 1000) -> None:
+    self.ttls = {name: ttl for name, ttl in ttls.items() if name not in NEVER_CACHE_TOOLS}
+    self.max_entries = max_entries
+    self.hits: dict[str, int] = {}
+    self.misses: dict[str, int] = {}
+    self._entries: OrderedDict[tuple[str, str], CacheEntry] = OrderedDict()
+
+  def cacheable(self, name: str) -> bool:
+    return name in self.ttls
+
+  def get(self, name: str, arguments: dict[str, Any] | None) -> CallToolResult | None:
+    key = (name, canonicalize(arguments))
+    entry = self._entries.get(key)
+    if entry is not None and entry.expires_at < time.monotonic():
+      del self._entries[key]
+      entry = None
+
+    if entry is None:
+      self.misses[name] = self.misses.get(name, 0) + 1
+      return None
+
+    self.hits[name] = self.hits.get(name, 0) + 1
+    self._entries.move_to_end(key)
+    return entry.result
+
+  def put(self, name: str, arguments: dict[str, Any] | None, result: CallToolResult) -> None:
+    # エラーの結果はキャッシュしない
+    if result.isError:
+      return
+    key = (name, canonicalize(arguments))
+    self._entries[key] = CacheEntry(result=result, expires_at=time.monotonic() + self.ttls[name])
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+
+  def stats(self) -> dict[str, Any]:
+    return {
+      "entries": len(self._entries),
+      "hits": dict(self.hits),
+      "misses": dict(self.misses),
+    }
+
+
+class CachedSession:
+  # ClientSession.call_toolと同じインターフェースでキャッシュを挟む
+  def __init__(self, session: Any, cache: ToolResultCache) -> None:
+    self.session = session
+    self.cache = cache
+
+  async def call_tool(self, name: str, arguments: dict[str, Any] | None = None) -> CallToolResult:
+    if not self.cache.cacheable(name):
+      return await self.session.call_tool(name, arguments)
+
+    result = self.cache.get(name, arguments)
+    if result is None:
+      result = await self.session.call_tool(name, arguments)
+      self.cache.put(name, arguments, result)
+    return result
+
+
+def canonicalize(arguments: dict[str, Any] | None) -> str:
+  # 引数の順番や空白の違いで別のキーにならないように正規化する
+  return json.dumps(arguments or {}, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
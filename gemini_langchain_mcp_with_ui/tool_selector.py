@@ -0,0 +1,115 @@
+import math
+import re
+from collections import Counter
+
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from response_cache import EmbedFn, cosine_similarity
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# URLはどのtoolの説明にも出てこない単語に分かれてしまうので"url"という1語にする
+_URL_PATTERN = re.compile(r"https?://\S+")
+_CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u9fff]+")
+
+
+# ほとんどのクエリとtoolの説明に出てくるので関連度の計算に使わない英単語
+STOPWORDS = frozenset(
+  """
+  a about an and any are as at be but by can could did do does for from get give has have how i if in is it its
+  let me my no not of on or please say says should so some tell than that the their them then there these they
+  this those to use using want was we what when where which who why will with would you your
+  """.split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+  # 英数字は単語(snake_caseは分割), 日本語は文字のbigramにする
+  text = _URL_PATTERN.sub(" url ", text.lower())
+  tokens = [token for token in _WORD_PATTERN.findall(text) if token not in STOPWORDS]
+  for run in _CJK_PATTERN.findall(text):
+    tokens.extend(run[i : i + 2] for i in range(max(1, len(run) - 1)))
+  return tokens
+
+
+def tool_text(tool: BaseTool) -> str:
+  return " ".join([tool.name, tool.description or "", *tool.args])
+
+
+def schema_tokens(tool: BaseTool) -> int:
+  # bindしたときにプロンプトに入るtoolの定義のトークン数の目安
+  return len(str(convert_to_openai_tool(tool)).encode()) // 4
+
+
+class ToolIndex:
+  """
+  toolの名前と説明のインデックス.
+  embeddingsがあれば埋め込みのcos類似度で, 無ければBM25でクエリとの関連度を計算する.
+  """
+
+  def __init__(self, tools: list[BaseTool], embeddings: list[list[float]] | None = None) -> None:
+    self.tools = tools
+    self.embeddings = embeddings
+    self.schema_tokens = {tool.name: schema_tokens(tool) for tool in tools}
+
+    self._docs = [Counter(tokenize(tool_text(tool))) for tool in tools]
+    self._avg_len = sum(sum(doc.values()) for doc in self._docs) / max(1, len(self._docs))
+    df = Counter(token for doc in self._docs for token in doc)
+    self._idf = {token: math.log(1 + (len(tools) - n + 0.5) / (n + 0.5)) for token, n in df.items()}
+
+  def scores(self, query: str, query_embedding: list[float] | None = None) -> list[float]:
+    if self.embeddings is not None and query_embedding is not None:
+      return [cosine_similarity(query_embedding, embedding) for embedding in self.embeddings]
+
+    query_tokens = set(tokenize(query))
+    scores = []
+    for doc in self._docs:
+      length = sum(doc.values())
+      score = 0.0
+      for token in query_tokens:
+        tf = doc.get(token, 0)
+        if tf:
+          norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self._avg_len)
+          score += self._idf[token] * tf * (BM25_K1 + 1) / (tf + norm)
+      scores.append(score)
+    return scores
+
+  def select(
+    self,
+    query: str,
+    top_k: int,
+    always_include: set[str],
+    min_score: float,
+    query_embedding: list[float] | None = None,
+    min_relative_score: float = 0.0,
+  ) -> list[BaseTool]:
+    """
+    クエリに関連するtop_k個のtoolとalways_includeのtoolを返す.
+    一番関連度が高いtoolのmin_relative_score倍に満たないtoolは選ばない.
+    関連するtoolが1つも無い(min_score以下)場合はすべてのtoolを返す.
+    """
+    if len(self.tools) <= top_k:
+      return self.tools
+
+    scores = self.scores(query, query_embedding)
+    ranked = sorted(range(len(self.tools)), key=lambda i: scores[i], reverse=True)
+    top_score = scores[ranked[0]]
+    if top_score <= min_score:
+      return self.tools
+
+    threshold = max(min_score, top_score * min_relative_score)
+    selected = {i for i in ranked[:top_k] if scores[i] > min_score and scores[i] >= threshold}
+    selected |= {i for i, tool in enumerate(self.tools) if tool.name in always_include}
+    # toolの順番はbindしたときのプロンプトが安定するように元の順番のままにする
+    return [tool for i, tool in enumerate(self.tools) if i in selected]
+
+
+async def build_tool_index(tools: list[BaseTool], embed: EmbedFn | None = None) -> ToolIndex:
+  if embed is None:
+    return ToolIndex(tools)
+  embeddings = [await embed(tool_text(tool)) for tool in tools]
+  return ToolIndex(tools, embeddings)
@@ -1,16 +1,24 @@
 import ast
 import json
+import os
+from collections.abc import Iterator
+from typing import Any
 
 import requests
 import streamlit as st
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
-from langchain_core.messages.base import messages_to_dict
-from langchain_core.messages.utils import messages_from_dict
+from langchain_core.messages import SystemMessage
+from requests.adapters import HTTPAdapter
+
+from chat_history import ChatEntry, ChatHistory, Conversation
 
 TEMPERATUE = 0.5
-SEND_MSG_SIZE = 10
 
 INF_SERVER_URL = "http://localhost:8000"
+# 推論サーバへのリクエストのタイムアウト(接続, 読み込み). 推論はサーバ側の上限(300秒)より長く待つ
+TOOLS_TIMEOUT = (3.0, 10.0)
+INFER_TIMEOUT = (3.0, 330.0)
+# ストリーミング表示(/infer/stream)を既定にする
+STREAMING = True
 
 personality_options: dict[str, str] = {
   "funny": "あなたは優秀なAIエージェントです。気さくで楽しく明るい性格で、ユーザの入力に対してユーモラスに返答してください。",
@@ -21,6 +29,13 @@ personality_options: dict[str, str] = {
 
 agent_name = "そしてあなたの名前は 'Welld' です！"
 
+# メッセージの種類 -> 表示するロール
+ROLES = {"human": "User", "ai": "Assistant", "tool": "Tool", "system": "system"}
+
+# UIの会話履歴を保存するSQLiteのファイルと, 1回に読み込む(描画する)メッセージ数
+HISTORY_DB_PATH = os.environ.get("UI_HISTORY_DB", "ui_history.sqlite3")
+HISTORY_PAGE_SIZE = 20
+
 
 def get_system_message(personality: str) -> SystemMessage:
   return SystemMessage(
@@ -29,6 +44,35 @@ def get_system_message(personality: str) -> SystemMessage:
   )
 
 
+@st.cache_resource
+def get_http_session() -> requests.Session:
+  # 推論サーバへのリクエストはすべてこのセッションを使い, keep-aliveの接続を使い回す
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=16)
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+
+def get_tools() -> dict[str, str]:
+  # toolの一覧はセッションに保存しておき, 変わっていないか(ETag)だけを毎回確認する
+  headers = {}
+  if "tools_etag" in st.session_state:
+    headers["If-None-Match"] = st.session_state.tools_etag
+  try:
+    response = get_http_session().get(INF_SERVER_URL + "/tools", headers=headers, timeout=TOOLS_TIMEOUT)
+  except requests.exceptions.RequestException:
+    print("failed to get tools")
+    return st.session_state.get("tools", {})
+
+  if response.status_code == 304:
+    return st.session_state.tools
+  if response.ok:
+    st.session_state.tools = response.json()["tools"]
+    st.session_state.tools_etag = response.headers.get("ETag", "")
+  return st.session_state.get("tools", {})
+
+
 def main() -> None:
   # UIの初期化
   st.set_page_config(
@@ -36,101 +80,223 @@ def main() -> None:
   )
   st.title("Chat app using MCP")
 
-  # toolとresorceの取得
-  response = requests.get(INF_SERVER_URL + "/tools")
-  json_data = response.json()
-  json_data = json.loads(json_data["tools"])
-
+  # toolの取得
   st.subheader("Available tools")
-  for name, desc in json_data.items():
+  tools = get_tools()
+  with st.expander(f"{len(tools)} tools"):
+    for name, desc in tools.items():
+      st.write("-------------------------")
+      st.write(f"{name}: {desc}")
     st.write("-------------------------")
-    st.write(f"{name}: {desc}")
-  st.write("-------------------------")
 
   st.subheader("Chat history")
 
+  # 会話履歴はSQLiteに保存し, URLの?c=<会話ID>で再読み込み後も同じ会話を続けられるようにする
+  history = get_history()
+  conversation = load_conversation(history)
+
   # サイドバー
   st.sidebar.title("オプション")
-  selected_personality = st.sidebar.radio("性格を選んでね:", tuple(personality_options.keys()))
-  if "personality" not in st.session_state or st.session_state.personality != selected_personality:
-    st.session_state.personality = selected_personality
-    st.session_state.messages = []
+  personalities = tuple(personality_options.keys())
+  selected_personality = st.sidebar.radio(
+    "性格を選んでね:", personalities, index=personalities.index(conversation.personality)
+  )
+  # ストリーミング表示にすると最初のトークンが届いた時点から表示し, toolの実行状況も逐次表示する
+  streaming = st.sidebar.toggle("ストリーミング表示", value=STREAMING)
+  st.sidebar.button("新しい会話", on_click=start_conversation, args=(history, selected_personality))
+  if conversation.personality != selected_personality:
+    # 性格を変えたら新しい会話(推論サーバ側のセッションも新規)にする
+    conversation = start_conversation(history, selected_personality)
 
-  # ここはあとから修正
-  # 性格をPOSTして切り替えられると面白そう
-  if "messages" not in st.session_state:
-    st.session_state.messages = [get_system_message(selected_personality)]
+  # チャット履歴の描画
+  # 描画するのは読み込み済みのページだけで, それより前のメッセージはボタンで読み込む
+  messages: list[ChatEntry] = st.session_state.messages
+  if messages and messages[0].seq > 0:
+    st.button("以前のメッセージを読み込む", on_click=load_older, args=(history, conversation))
+  for entry in messages:
+    render_entry(entry)
 
   if user_input := st.chat_input("何でも入力してね！"):
-    # 会話履歴はlangchainのオブジェクトで管理する
-    st.session_state.messages.append(HumanMessage(content=user_input))
-
-    with st.spinner("AI agent is typing..."):
-      # 会話履歴 + ユーザの入力をjsonにしてAPIで推論サーバにpost
-      print("=================================")
-
-      # すべての履歴を送ると推論に時間がかかるので直近の数個を送る
-      # また先頭にid=0のsystem messageが無い場合は付与する
-      messages = st.session_state.messages[-SEND_MSG_SIZE:]
-      if not isinstance(messages[0], SystemMessage) and messages[0].id != 0:
-        messages.insert(0, get_system_message(selected_personality))
-
-      print("---------- [UI]: send data to infer server ----------")
-      for message in messages:
-        print(f"{message.__class__.__name__}: {message.content}")
-
-      json_input_data = messages_to_dict(messages)
-      json_str = json.dumps(json_input_data, indent=2)
-      try:
-        response = requests.post(INF_SERVER_URL + "/infer", json={"message": json_str})
-        json_data = response.json()
-        json_data = json.loads(json_data["response"])
-      except json.decoder.JSONDecodeError:
-        print("failed to parse json")
-        json_data = json_input_data
-
-    # 推論サーバからデータがjsonで来るのでlangchainのオブジェクトに変換
-    recevied_msgs = messages_from_dict(json_data)
+    user_entry = ChatEntry(role="User", content=user_input)
+    history.append(conversation.conversation_id, [user_entry])
+    add_entries([user_entry])
+    render_entry(user_entry)
+
+    # 会話履歴は推論サーバ側のセッションで保持しているので, 今回の入力とセッションIDだけをpost
+    print("=================================")
+    print("---------- [UI]: send data to infer server ----------")
+    print(f"HumanMessage: {user_input}(session: {st.session_state.session_id})")
+
+    input_data = {
+      "session_id": st.session_state.session_id,
+      "message": user_input,
+      "system_prompt": get_system_message(selected_personality).content,
+    }
+    if streaming:
+      json_data = infer_stream(input_data)
+    else:
+      json_data = infer(input_data)
     print("---------- [UI]: receved data from infer server ----------")
 
-    # 推論サーバからは履歴も含めて送られてくるので履歴を初期化する
-    st.session_state.messages = []
-    for message in recevied_msgs:
-      st.session_state.messages.append(message)
-
-      # デバッグ表示のために形式を変換
-      if isinstance(message, ToolMessage):
-        try:
-          contents = ast.literal_eval(message.content)
-          contents = [json.loads(content) for content in contents]
-        except (SyntaxError, ValueError):
-          contents = message.content
-      else:
-        contents = message.content
-
-      print(f"{message.__class__.__name__}: {contents}(id: {message.id})")
-
-    # チャット履歴の描画
-    messages = st.session_state.get("messages", [])
-    for message in messages:
-      content = message.content
-      if isinstance(message, AIMessage):
-        with st.chat_message("Assistant"):
-          st.markdown(content)
-      elif isinstance(message, HumanMessage):
-        with st.chat_message("User"):
-          st.markdown(content)
-      elif isinstance(message, ToolMessage):
-        with st.chat_message("Tool"):
-          try:
-            content = ast.literal_eval(content)
-            content = [json.loads(c) for c in content]
-          except (SyntaxError, ValueError):
-            content = message.content
-          st.markdown(content)
-      else:
-        with st.chat_message("system"):
-          st.markdown(content)
+    if st.session_state.session_id != conversation.session_id:
+      conversation.session_id = st.session_state.session_id
+      history.set_session_id(conversation.conversation_id, conversation.session_id)
+
+    # 推論サーバからは今回のターンで増えたメッセージだけが送られてくるので, 変換して履歴の末尾に追加する
+    entries = []
+    for message in json_data:
+      entry = to_entry(message)
+      print(f"{message['type']}: {entry.content}(id: {message['data'].get('id')})")
+      if entry.content:
+        entries.append(entry)
+        # ストリーミングでは描画済みなので, 一括で受け取った場合だけ描画する
+        if not streaming:
+          render_entry(entry)
+    history.append(conversation.conversation_id, entries)
+    add_entries(entries)
+
+
+@st.cache_resource
+def get_history() -> ChatHistory:
+  return ChatHistory(HISTORY_DB_PATH)
+
+
+def load_conversation(history: ChatHistory) -> Conversation:
+  if "conversation" in st.session_state:
+    return st.session_state.conversation
+  conversation_id = st.query_params.get("c")
+  conversation = history.get(conversation_id) if conversation_id else None
+  if conversation is None or conversation.personality not in personality_options:
+    return start_conversation(history, next(iter(personality_options)))
+  set_conversation(conversation, history.page(conversation.conversation_id, HISTORY_PAGE_SIZE))
+  return conversation
+
+
+def start_conversation(history: ChatHistory, personality: str) -> Conversation:
+  conversation = history.create(personality)
+  set_conversation(conversation, [])
+  return conversation
+
+
+def set_conversation(conversation: Conversation, messages: list[ChatEntry]) -> None:
+  st.session_state.conversation = conversation
+  st.session_state.session_id = conversation.session_id
+  st.session_state.messages = messages
+  st.session_state.history_limit = HISTORY_PAGE_SIZE
+  st.query_params["c"] = conversation.conversation_id
+
+
+def load_older(history: ChatHistory, conversation: Conversation) -> None:
+  messages = st.session_state.messages
+  older = history.page(conversation.conversation_id, HISTORY_PAGE_SIZE, before_seq=messages[0].seq)
+  st.session_state.messages = older + messages
+  st.session_state.history_limit += HISTORY_PAGE_SIZE
+
+
+def add_entries(entries: list[ChatEntry]) -> None:
+  # メモリ上には読み込んだページ数分の最新のメッセージだけを残す(古いものはSQLiteから読み直せる)
+  messages = st.session_state.messages + entries
+  st.session_state.messages = messages[-st.session_state.history_limit :]
+
+
+def client_headers() -> dict[str, str]:
+  # 推論サーバはクライアントごとに同時実行数を制限するので, UIの利用者(会話)ごとに別のクライアントとして名乗る
+  return {"X-Client-Id": st.session_state.conversation.conversation_id}
+
+
+def rejection_message(response: requests.Response) -> str:
+  # 429/503/504などで断られた場合の理由と, 待つべき時間(Retry-After)
+  try:
+    detail = response.json().get("detail", response.reason)
+  except (requests.exceptions.JSONDecodeError, AttributeError):
+    detail = response.reason
+  message = f"request rejected ({response.status_code}): {detail}"
+  if retry_after := response.headers.get("Retry-After"):
+    message += f" - retry after {retry_after}s"
+  return message
+
+
+def infer(input_data: dict[str, Any]) -> list[dict[str, Any]]:
+  with st.spinner("AI agent is typing..."):
+    try:
+      response = get_http_session().post(
+        INF_SERVER_URL + "/infer", json=input_data, headers=client_headers(), timeout=INFER_TIMEOUT
+      )
+      if not response.ok:
+        st.error(rejection_message(response))
+        return []
+      json_data = response.json()
+      st.session_state.session_id = json_data["session_id"]
+      return json_data["messages"]
+    except (requests.exceptions.JSONDecodeError, KeyError):
+      print("failed to parse json")
+    except requests.exceptions.RequestException as e:
+      print(f"failed to request infer server: {e}")
+  return []
+
+
+def infer_stream(input_data: dict[str, Any]) -> list[dict[str, Any]]:
+  # /infer/streamのNDJSONを1行ずつ読み, トークンはst.write_streamで, toolの実行状況はst.statusで逐次表示する
+  result: dict[str, Any] = {"messages": [], "error": False}
+
+  def tokens(response: requests.Response, status: Any) -> Iterator[str]:
+    for line in response.iter_lines():
+      if not line:
+        continue
+      event = json.loads(line)
+      if event["type"] == "token":
+        yield event["content"]
+      elif event["type"] == "tool_start":
+        status.update(label=f"running {event['name']}...", state="running")
+        status.write(f"▶ {event['name']}: {event['input']}")
+      elif event["type"] == "tool_end":
+        status.update(label=f"{event['name']} finished", state="running")
+        status.write(f"✔ {event['name']}: {len(event['output'])} chars")
+      elif event["type"] == "messages":
+        st.session_state.session_id = event["session_id"]
+        result["messages"] = event["messages"]
+      elif event["type"] == "error":
+        result["error"] = True
+        status.update(label="error", state="error")
+        status.write(event["message"])
+
+  with st.chat_message("Assistant"):
+    status = st.status("AI agent is typing...", expanded=False)
+    try:
+      with get_http_session().post(
+        INF_SERVER_URL + "/infer/stream", json=input_data, headers=client_headers(), timeout=INFER_TIMEOUT, stream=True
+      ) as response:
+        if not response.ok:
+          status.update(label=rejection_message(response), state="error")
+          return []
+        st.write_stream(tokens(response, status))
+    except requests.exceptions.RequestException as e:
+      print(f"failed to request infer server: {e}")
+      status.update(label="failed to request infer server", state="error")
+      return []
+    if not result["error"]:
+      status.update(label="done", state="complete")
+  return result["messages"]
+
+
+def to_entry(message: dict[str, Any]) -> ChatEntry:
+  # 推論サーバから来たjson(messages_to_dictの形式)を描画用の形に変換する
+  data = message["data"]
+  content = data["content"]
+  if message["type"] == "tool":
+    # toolの出力はjson文字列のリストの文字列表現で来るので, デコードした形で表示する
+    try:
+      content = [json.loads(c) for c in ast.literal_eval(content)]
+    except (SyntaxError, ValueError, TypeError):
+      pass
+  if not isinstance(content, str):
+    content = str(content)
+  return ChatEntry(role=ROLES.get(message["type"], "system"), content=content)
+
+
+def render_entry(entry: ChatEntry) -> None:
+  with st.chat_message(entry.role):
+    st.markdown(entry.content)
 
 
 if __name__ == "__main__":